@@ -6,6 +6,8 @@ import subprocess
 import time
 import logging
 import coloredlogs
+import trace_cache
+import trace_reader
 import trace_parser as tp
 coloredlogs.install(level='INFO')
 
@@ -35,6 +37,8 @@ for _site_dir in working_dirs:
             os.makedirs(_analysis_dir)
         _trace_dir = os.path.join(_run_dir, 'trace')
         for _file in os.listdir(_trace_dir):
+            if _file.endswith(trace_cache.CACHE_SUFFIX):
+                continue
             _trace_file = os.path.join(_trace_dir, _file)
             _output_file = os.path.join(_analysis_dir, _file.split('.trace')[0] + '.json')
             _waterfall_file = os.path.join(_analysis_dir, _file.split('.trace')[0] + '.html')
@@ -47,11 +51,32 @@ for _site_dir in working_dirs:
             logging.info('Analyzing ' + _run_no + ' site: ' + _site_dir)
             #subprocess.call([_command, '-vvv',  '-t', _trace_file, '-o', _output_file, '-w', _waterfall_file], timeout = 300)
             trace = tp.Trace(_trace_file)
-            _result, _start_ts, _cpu_times = trace.analyze()
+            _valid, _reason = trace.Validate()
+            if not _valid and trace.truncated:
+                # Report the cut off, then analyze the events that made it into the file
+                logging.warning('Salvaging truncated trace file ' + _file + ': ' + _reason)
+                trace = tp.Trace(_trace_file, salvage=True)
+                _valid, _reason = trace.Validate()
+            if not _valid:
+                logging.warning('Skipping trace file ' + _file + ': ' + _reason)
+                continue
+            try:
+                try:
+                    _result, _start_ts, _cpu_times = trace.analyze()
+                except trace_reader.TruncatedTrace as e:
+                    # Where a compressed trace was cut off may only show once it is read
+                    logging.warning('Salvaging truncated trace file ' + _file + ': ' + str(e))
+                    trace = tp.Trace(_trace_file, salvage=True)
+                    _result, _start_ts, _cpu_times = trace.analyze()
+            except trace_reader.MalformedTrace as e:
+                logging.warning('Skipping malformed trace file ' + _file + ': ' + str(e))
+                continue
             if not _result or not _start_ts or not _cpu_times:
                 logging.warning('Incomplet trace file: ' + _file )
                 continue
             _load_time = round(((float(_time['load'])* 1000000)  - float(_start_ts)) / 1000, 2)
             _result.insert(0, {'load': _load_time, 'cpu_time': _cpu_times['total_usecs']})
+            if trace.partial:
+                _result[0]['partial'] = True
             trace.WriteJson(_output_file, _result)
             shutil.copy(_output_file, _wprofx_graphs)
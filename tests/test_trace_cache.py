@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import trace_cache
+import trace_parser
+from test_trace_parser import TraceTestCase
+
+
+class TraceCacheTest(TraceTestCase):
+    # A trace analyzed from its cache has to give the results of parsing it, and a cache that doesn't match the trace
+    # or the parser any more has to be parsed again
+
+    def setUp(self):
+        TraceTestCase.setUp(self)
+        self.write_trace()
+        self.cache = trace_cache.cache_path(self.path)
+
+    def load(self, parser_version=trace_parser.PARSER_VERSION):
+        return trace_cache.load(self.path, parser_version)
+
+    def test_hit(self):
+        expected = self.analyze(cache=False)
+        self.assertFalse(os.path.exists(self.cache))
+        self.assertEqual(self.analyze(cache=True), expected)
+        self.assertIsNotNone(self.load())
+        self.assertEqual(self.analyze(cache=True), expected)
+
+    def test_stale_mtime(self):
+        self.analyze(cache=True)
+        st = os.stat(self.path)
+        os.utime(self.path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+        self.assertIsNone(self.load())
+
+    def test_stale_size(self):
+        self.analyze(cache=True)
+        with open(self.path, 'a') as f:
+            f.write('\n')
+        self.assertIsNone(self.load())
+
+    def test_stale_parser_version(self):
+        self.analyze(cache=True)
+        self.assertIsNotNone(self.load())
+        self.assertIsNone(self.load(trace_parser.PARSER_VERSION + 1))
+
+    def test_corrupt(self):
+        expected = self.analyze(cache=True)
+        for data in [b'', b'garbage', open(self.cache, 'rb').read()[:100]]:
+            with open(self.cache, 'wb') as f:
+                f.write(data)
+            self.assertIsNone(self.load())
+            # Parsed again, and the cache rewritten
+            self.assertEqual(self.analyze(cache=True), expected)
+            self.assertIsNotNone(self.load())
+
+    def test_mixed_numbers(self):
+        # Integer and fractional timestamps in the same column each come back as they were read
+        trace_events = [{'pid': 1, 'tid': 2, 'ts': 123, 'ph': 'X', 'cat': 'c', 'name': 'a', 'dur': 5},
+                        {'pid': 1, 'tid': 2, 'ts': 123.5, 'ph': 'X', 'cat': 'c', 'name': 'b', 'dur': 0.25},
+                        {'pid': 1, 'tid': 2, 'ts': 124, 'ph': 'I', 'cat': 'c', 'name': 'c', 'tts': 7}]
+        trace_cache.save(self.path, trace_parser.PARSER_VERSION, trace_events)
+        loaded = self.load()[0]
+        self.assertEqual(loaded, trace_events)
+        self.assertEqual([[type(event[key]) for key in sorted(event)] for event in loaded],
+                         [[type(event[key]) for key in sorted(event)] for event in trace_events])
+
+    def test_partial(self):
+        trace_cache.save(self.path, trace_parser.PARSER_VERSION, [], {'partial': True, 'partial_cutoff': 0})
+        self.assertIsNotNone(trace_cache.load(self.path, trace_parser.PARSER_VERSION))
+        self.assertIsNone(trace_cache.load(self.path, trace_parser.PARSER_VERSION, partial=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,554 @@
+import base64
+import contextlib
+import gzip
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import trace_parser
+import trace_reader
+
+T0 = 1000000000
+MAIN = 'http://www.example.com/'
+SCRIPT = 'http://www.example.com/a.js'
+
+
+def trace_event(name, ts, ph, cat='devtools.timeline', pid=10, tid=1, args=None, **fields):
+    event = {'pid': pid, 'tid': tid, 'ts': ts, 'ph': ph, 'cat': cat, 'name': name, 'args': args or {}}
+    event.update(fields)
+    return event
+
+
+def netlog_event(name, ts, ph, source_id, source_type, params=None):
+    return trace_event(name, ts, ph, cat='netlog', pid=1, tid=7, id=hex(source_id),
+                       args={'source_type': source_type, 'params': params or {}})
+
+
+def trace_events():
+    # A page load on the renderer's main thread, the browser's netlog, and browser/GPU noise: both the events no stage
+    # reads and timeline events the CPU accounting still sees
+    events = []
+
+    def add(*args, **fields):
+        events.append(trace_event(*args, **fields))
+
+    def request(request_id, url, start, end, mime_type, size):
+        add('ResourceSendRequest', start, 'I', args={'data': {'requestId': request_id, 'url': url}})
+        add('ResourceReceiveResponse', end - 2000, 'I',
+            args={'data': {'requestId': request_id, 'statusCode': 200, 'mimeType': mime_type}})
+        add('ResourceReceivedData', end - 1000, 'I',
+            args={'data': {'requestId': request_id, 'encodedDataLength': size}})
+        add('ResourceFinish', end, 'I', args={'data': {'requestId': request_id, 'didFail': False}})
+
+    add('ResourceSendRequest', T0 - 500, 'I', pid=30, tid=3,
+        args={'data': {'requestId': '1.0', 'url': trace_parser.HARNESS_URL + '/json'}})
+    request('10.1', MAIN, T0, T0 + 100000, 'text/html', 4000)
+    add('ParseHTML', T0 + 101000, 'B', args={'beginData': {'url': MAIN, 'startLine': 0}})
+    request('10.2', SCRIPT, T0 + 102000, T0 + 150000, 'application/javascript', 5000)
+    add('ParseHTML', T0 + 120000, 'E', args={'endData': {'endLine': 10}})
+    add('EvaluateScript', T0 + 160000, 'X', dur=20000, args={'data': {'url': SCRIPT, 'lineNumber': 1}})
+    for i in range(10):
+        add('FunctionCall', T0 + 161000 + i * 1500, 'X', dur=1000,
+            args={'data': {'scriptName': SCRIPT, 'functionName': 'f{0:d}'.format(i)}})
+    add('Layout', T0 + 181000, 'X', dur=500, args={'beginData': {}})
+    add('Paint', T0 + 182000, 'X', cat='devtools.timeline,rail', dur=200, args={'data': {'frame': '0x1'}})
+    for i in range(50):
+        ts = T0 + i * 4000
+        add('Paint', ts, 'X', pid=20, tid=2, dur=5, args={'data': {}})
+        add('GPUTask', ts, 'X', cat='gpu', pid=20, tid=2, dur=5)
+        add('RunTask', ts, 'X', cat='toplevel', pid=1, tid=5, dur=50, args={'src': 'x'})
+        add('UseCounter', ts, 'I', cat='disabled-by-default-blink.feature_usage', args={'feature': i})
+
+    def netlog(*args):
+        events.append(netlog_event(*args))
+
+    netlog('URL_REQUEST_START_JOB', T0 + 50, 'b', 7, 'URL_REQUEST', {'url': MAIN, 'method': 'GET'})
+    netlog('DNS_TRANSACTION', T0 + 100, 'b', 5, 'DNS_TRANSACTION', {'hostname': 'www.example.com'})
+    netlog('DNS_TRANSACTION', T0 + 20100, 'e', 5, 'DNS_TRANSACTION')
+    netlog('TCP_CONNECT', T0 + 20200, 'b', 8, 'SOCKET', {'address_list': ['1.2.3.4:80']})
+    netlog('TCP_CONNECT', T0 + 40200, 'e', 8, 'SOCKET', {'source_address': '10.0.0.1:5555'})
+    netlog('HTTP_STREAM_REQUEST_BOUND_TO_JOB', T0 + 40250, 'n', 7, 'URL_REQUEST', {'source_dependency': {'id': 12}})
+    netlog('HTTP_STREAM_JOB_BOUND_TO_REQUEST', T0 + 40250, 'n', 12, 'HTTP_STREAM_JOB', {'source_dependency': {'id': 7}})
+    netlog('SOCKET_POOL_BOUND_TO_SOCKET', T0 + 40300, 'n', 12, 'HTTP_STREAM_JOB', {'source_dependency': {'id': 8}})
+    netlog('SOCKET_IN_USE', T0 + 40300, 'b', 8, 'SOCKET', {'source_dependency': {'id': 12}})
+    netlog('SOCKET_BYTES_RECEIVED', T0 + 80000, 'n', 8, 'SOCKET', {'byte_count': 4000})
+    netlog('SOCKET_IN_USE', T0 + 100000, 'e', 8, 'SOCKET')
+    # Per-thread buffers are flushed in turn, the file isn't in ts order
+    events.sort(key=lambda event: (event['pid'], event['tid']))
+    return events
+
+
+def write_trace(path, layout, events):
+    with open(path, 'w') as f:
+        if layout == 'strings':
+            json.dump([json.dumps(event) for event in events], f)
+        elif layout == 'lines':
+            f.write('\n'.join(json.dumps(event) for event in events) + '\n')
+        else:
+            json.dump({'traceEvents': events}, f)
+    return path
+
+
+class TraceTestCase(unittest.TestCase):
+    # Each test writes its trace to a scratch directory of its own
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'test.trace')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_trace(self, events=None, layout='strings'):
+        return write_trace(self.path, layout, trace_events() if events is None else events)
+
+    def run_trace(self, cache=False, **kwargs):
+        # The Trace and what its analyze() returned
+        trace = trace_parser.Trace(self.path, cache=cache, **kwargs)
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = trace.analyze()
+        return trace, result
+
+    def analyze(self, **kwargs):
+        # What analyze() returned as JSON, to compare runs
+        return json.dumps(self.run_trace(**kwargs)[1], sort_keys=True, default=str)
+
+
+class PruneUnroutedTest(TraceTestCase):
+    # Pruning on ingestion only skips events no stage reads, so it has to give exactly the results of a full run
+
+    def test_same_results(self):
+        for layout in ['strings', 'wrapped', 'lines']:
+            self.write_trace(layout=layout)
+            expected = self.analyze(prune_unrouted=False)
+            self.assertNotEqual(json.loads(expected)[0], False)
+            self.assertEqual(self.analyze(), expected, layout)
+
+    def test_skips_unread_events(self):
+        for layout in ['strings', 'wrapped', 'lines']:
+            path = self.write_trace(layout=layout)
+            trace = trace_parser.Trace(path, cache=False)
+            self.assertEqual(len(list(trace.ReadTraceEvents(prune=True))),
+                             len(list(trace.ReadTraceEvents())) - 150, layout)
+
+
+class ParallelTest(TraceTestCase):
+    # Parsing byte ranges in a process pool has to give the results of a serial run, and fail the same way
+
+    def test_same_results(self):
+        for layout in ['strings', 'lines']:
+            path = self.write_trace(layout=layout)
+            self.assertIsNotNone(trace_reader.split_trace(path, 8), layout)
+            expected = self.analyze()
+            self.assertNotEqual(json.loads(expected)[0], False)
+            self.assertEqual(self.analyze(workers=2), expected, layout)
+            self.assertEqual(self.analyze(workers=2, prune_unrouted=False), expected, layout)
+
+    def test_truncated(self):
+        for layout in ['strings', 'lines']:
+            path = self.write_trace(layout=layout)
+            with open(path, 'r+') as f:
+                f.truncate(os.path.getsize(path) - 30)
+            with self.assertRaises(trace_reader.TruncatedTrace):
+                self.analyze(workers=2)
+
+    def test_malformed(self):
+        for layout in ['strings', 'lines']:
+            path = self.write_trace(layout=layout)
+            with open(path, 'r+') as f:
+                text = f.read()
+                offset = text.index('ParseHTML')
+                f.seek(offset)
+                f.write('Parse"HTML')
+            with self.assertRaisesRegex(trace_reader.MalformedTrace, 'byte offset'):
+                self.analyze(workers=2)
+
+
+class NetworkTest(TraceTestCase):
+    # What the netlog and the network events add to the Networking activities and the page-wide output entries
+
+    def analyze_network(self, extra_events=()):
+        self.write_trace(trace_events() + list(extra_events), 'wrapped')
+        result = self.run_trace()[1][0]
+        self.assertNotEqual(result, False)
+        self.entries = dict((entry['id'], entry) for entry in result if 'id' in entry)
+        self.critical_path = result[-1]
+        self.requests = dict((obj['id'], obj) for entry in result if 'objs' in entry for obj in entry['objs']
+                             if obj.get('activityId', '').startswith('Networking'))
+
+    def test_http2_streams(self):
+        headers = [':authority: www.example.com', ':method: GET', ':path: /a.js', ':scheme: http']
+        self.analyze_network([
+            netlog_event('HTTP2_SESSION_SEND_HEADERS', T0 + 102100, 'n', 32, 'HTTP2_SESSION',
+                         {'stream_id': 1, 'headers': headers, 'weight': 220, 'parent_stream_id': 0,
+                          'exclusive': True}),
+            netlog_event('HTTP2_SESSION_RECV_HEADERS', T0 + 147000, 'n', 32, 'HTTP2_SESSION', {'stream_id': 1}),
+            netlog_event('HTTP2_SESSION_RECV_DATA', T0 + 148500, 'n', 32, 'HTTP2_SESSION',
+                         {'stream_id': 1, 'size': 5000}),
+            # A stream no request was made for, e.g. a push
+            netlog_event('HTTP2_SESSION_RECV_DATA', T0 + 149000, 'n', 32, 'HTTP2_SESSION',
+                         {'stream_id': 2, 'size': 100})])
+        http2 = self.entries['Netlog']['http2']
+        self.assertEqual(http2['bytes_in'], 5100)
+        streams = http2['sessions']['0x20']['streams']
+        self.assertEqual(streams['1']['firstByte'], 147.0)
+        self.assertEqual(streams['1']['bytes_in'], 5000)
+        self.assertEqual(streams['1']['url'], SCRIPT)
+        self.assertIsNone(streams['2']['activityId'])
+        script_request = self.requests['10.2']
+        self.assertEqual(streams['1']['activityId'], script_request['activityId'])
+        self.assertEqual(script_request['http2'], {'session': '0x20', 'streamId': 1, 'priority': 220,
+                                                   'parentStreamId': 0})
+        self.assertNotIn('http2', self.requests['10.1'])
+
+    def test_network_phases(self):
+        # The script is requested on the main document's connection once it is free again
+        self.analyze_network([
+            netlog_event('HTTP_TRANSACTION_SEND_REQUEST', T0 + 40400, 'b', 7, 'URL_REQUEST'),
+            netlog_event('HTTP_TRANSACTION_SEND_REQUEST', T0 + 40500, 'e', 7, 'URL_REQUEST'),
+            netlog_event('URL_REQUEST_START_JOB', T0 + 102050, 'b', 9, 'URL_REQUEST', {'url': SCRIPT, 'method': 'GET'}),
+            netlog_event('HTTP_STREAM_REQUEST_BOUND_TO_JOB', T0 + 102100, 'n', 9, 'URL_REQUEST',
+                         {'source_dependency': {'id': 13}}),
+            netlog_event('SOCKET_POOL_BOUND_TO_SOCKET', T0 + 102100, 'n', 13, 'HTTP_STREAM_JOB',
+                         {'source_dependency': {'id': 8}}),
+            netlog_event('SOCKET_IN_USE', T0 + 102100, 'b', 8, 'SOCKET', {'source_dependency': {'id': 13}}),
+            netlog_event('SOCKET_IN_USE', T0 + 150000, 'e', 8, 'SOCKET')])
+        self.assertEqual(self.requests['10.1']['phases'], {'queueing': 0.1, 'dns': 20.0, 'connect': 20.0, 'tls': -1,
+                                                           'request': 0.1, 'ttfb': 57.5, 'download': 2.0})
+        # A reused connection was neither looked up nor connected for this request
+        self.assertEqual(self.requests['10.2']['phases'], {'queueing': -1, 'dns': -1, 'connect': -1, 'tls': -1,
+                                                           'request': -1, 'ttfb': 46.0, 'download': 2.0})
+        connection = self.entries['Netlog']['connections']['0x8']
+        self.assertEqual(connection['activities'], [self.requests['10.1']['activityId'],
+                                                    self.requests['10.2']['activityId']])
+        self.assertEqual(connection['idle'], [{'startTime': 40.2, 'endTime': 40.3},
+                                              {'startTime': 100.0, 'endTime': 102.1}])
+        self.assertEqual(self.critical_path['networkingPhases'], {'queueing': 0.1, 'dns': 20.0, 'connect': 20.0,
+                                                                  'tls': 0, 'request': 0.1, 'ttfb': 103.5,
+                                                                  'download': 4.0})
+
+    def test_bandwidth(self):
+        # The script arrives in two parts
+        self.analyze_network([trace_event('ResourceReceivedData', T0 + 149500, 'I',
+                                  args={'data': {'requestId': '10.2', 'encodedDataLength': 1000}})])
+        self.assertEqual(self.requests['10.1']['transferSize'], 4000)
+        self.assertEqual(self.requests['10.2']['transferSize'], 6000)
+        self.assertEqual(self.requests['10.2']['bytesReceived'], [[149.0, 5000], [149.5, 6000]])
+        bandwidth = self.entries['Bandwidth']
+        self.assertEqual(bandwidth['bucketMs'], 10)
+        self.assertEqual(bandwidth['bytes'], [0] * 9 + [4000] + [0] * 4 + [6000, 0])
+        self.assertEqual(bandwidth['inFlight'], [1] * 10 + [2] + [1] * 5)
+        self.assertEqual(bandwidth['peakKbps'], 4800.0)
+        self.assertEqual(bandwidth['latencyBoundTime'], 140)
+
+    def test_redirect_bandwidth(self):
+        # Bytes the redirect response brought in are the hop's, not the final request's
+        self.analyze_network([trace_event('ResourceSendRequest', T0 + 101500, 'I',
+                                  args={'data': {'requestId': '10.2', 'url': 'http://cdn.example.com/a.js'}}),
+                              trace_event('ResourceReceivedData', T0 + 101800, 'I',
+                                  args={'data': {'requestId': '10.2', 'encodedDataLength': 300}})])
+        hop = self.requests['10.2:redirected.0']
+        self.assertEqual(hop['transferSize'], 300)
+        self.assertEqual(hop['bytesReceived'], [[101.8, 300]])
+        self.assertEqual(self.requests['10.2']['transferSize'], 5000)
+        self.assertEqual(self.requests['10.2']['bytesReceived'], [[149.0, 5000]])
+        self.assertEqual(sum(self.entries['Bandwidth']['bytes']), 9300)
+
+    def test_redirect(self):
+        # The script's request was redirected from another host, Chrome sends both under the same requestId
+        self.analyze_network([trace_event('ResourceSendRequest', T0 + 101500, 'I',
+                                  args={'data': {'requestId': '10.2', 'url': 'http://cdn.example.com/a.js'}})])
+        hop = self.requests['10.2:redirected.0']
+        self.assertTrue(hop['redirect'])
+        self.assertEqual(hop['url'], 'http://cdn.example.com/a.js')
+        self.assertEqual((hop['startTime'], hop['endTime']), (101.5, 102.0))
+        script_request = self.requests['10.2']
+        self.assertNotIn('redirect', script_request)
+        self.assertEqual(script_request['url'], SCRIPT)
+        self.assertEqual(script_request['redirectedFrom'], hop['activityId'])
+        self.assertIn({'time': 102.0, 'a1': hop['activityId'], 'a2': script_request['activityId']},
+                      self.entries['Deps']['objs'])
+        self.assertIn(hop['activityId'], self.critical_path['criticalPath'])
+        self.assertEqual(self.critical_path['redirectTime'], 0.5)
+
+
+class TimelineTest(TraceTestCase):
+    # What the per-thread timeline tree and the CPU accounting built on it give for hand-made main thread events
+
+    def nested_events(self):
+        # A compile that starts with the script and a GC inside its first function call, each written ahead of the
+        # event holding it the way Chrome writes complete events
+        events = trace_events()
+        index = [i for i, event in enumerate(events) if event['name'] == 'EvaluateScript'][0]
+        events.insert(index, trace_event('v8.compile', T0 + 160000, 'X', dur=1000,
+                                         args={'data': {'url': SCRIPT}}))
+        index = [i for i, event in enumerate(events) if event['name'] == 'FunctionCall'][0]
+        events.insert(index, trace_event('MinorGC', T0 + 161200, 'X', dur=300))
+        return events
+
+    def test_nested_complete_events(self):
+        self.write_trace(self.nested_events())
+        trace, (result, start_ts, cpu) = self.run_trace()
+        names = trace.event_name_lookup
+        script = [event for event in trace.timeline_events if names[event.n] == 'EvaluateScript'][0]
+        self.assertEqual([names[child.n] for child in script.c], ['v8.compile'] + ['FunctionCall'] * 10)
+        self.assertEqual([names[child.n] for child in script.c[1].c], ['MinorGC'])
+        scripting = [obj for entry in result if entry.get('id') == SCRIPT for obj in entry['objs']
+                     if obj['activityId'] == 'Scripting_0'][0]
+        self.assertEqual(scripting['phases'], {'compile': 1.0, 'execute': 18.7, 'gc': 0.3})
+
+    def test_main_thread_cpu(self):
+        # Main thread time per category inside windows cutting through the nested events: the compile is 160-161 ms,
+        # the GC 161.2-161.5 ms inside the first call, the script's 20 ms less those is scripting
+        self.write_trace(self.nested_events())
+        trace = self.run_trace()[0]
+        used = trace.MainThreadCPU([160.5, 100.0, 130.0], [161.3, 181.25, 150.0])
+        windows = [{category: round(float(used[c, i]), 3) for c, category in enumerate(trace_parser.CPU_CATEGORIES)
+                    if used[c, i]} for i in range(3)]
+        self.assertEqual(windows, [{'compile': 0.5, 'scripting': 0.2, 'gc': 0.1},
+                                   {'loading': 19.0, 'compile': 1.0, 'scripting': 18.7, 'gc': 0.3, 'rendering': 0.25},
+                                   {}])
+
+    def test_long_tasks(self):
+        # A 60 ms task from 155 ms holding the script, layout and paint; the main thread is otherwise busy 0-1 us and
+        # 101-120 ms (ParseHTML) and requests are in flight 0-100 ms and 102-150 ms, the trace is 196.005 ms long
+        self.write_trace(trace_events() + [trace_event('TimerFire', T0 + 155000, 'X', dur=60000)])
+        result = self.run_trace()[1][0]
+        main_thread = [entry for entry in result if entry.get('id') == 'MainThread'][0]
+        self.assertEqual(main_thread['longTasks'], [{'startTime': 155.0, 'endTime': 215.0, 'duration': 60.0,
+                                                     'activities': ['Scripting_0']}])
+        self.assertEqual(main_thread['idleGaps'], [{'startTime': 0.001, 'endTime': 100.0},
+                                                   {'startTime': 120.0, 'endTime': 150.0}])
+        self.assertAlmostEqual(main_thread['busyTime'], 79.001)
+        self.assertAlmostEqual(main_thread['idleTime'], 100.999 + 35)
+        self.assertAlmostEqual(main_thread['networkWaitTime'], 99.999 + 30)
+
+    def test_adjacent_tasks(self):
+        # Two 30 ms tasks back to back are two tasks under LONG_TASK_MS, not one long task
+        self.write_trace(trace_events() + [trace_event('TimerFire', T0 + 200000, 'X', dur=30000),
+                                           trace_event('FireAnimationFrame', T0 + 230000, 'X', dur=30000)])
+        result = self.run_trace()[1][0]
+        main_thread = [entry for entry in result if entry.get('id') == 'MainThread'][0]
+        self.assertEqual(main_thread['longTasks'], [])
+        # ParseHTML, the script, layout and paint take 39.7 ms and the instant events 1 us
+        self.assertAlmostEqual(main_thread['busyTime'], 99.701)
+
+
+class CPUSlicesTest(TraceTestCase):
+    # The fixture's main thread in 1 ms slices: the script runs 160-180 ms with 1 ms function calls starting every
+    # 1.5 ms from 161 ms, so the calls take whole slices and half slices in turn and the script has the rest
+
+    def setUp(self):
+        TraceTestCase.setUp(self)
+        self.write_trace()
+        self.cpu = self.run_trace(slice_usecs=1000)[1][2]
+
+    def test_slices(self):
+        self.assertEqual(self.cpu['slice_usecs'], 1000)
+        slices = self.cpu['slices']['10:1']
+        self.assertEqual(len(slices['EvaluateScript']), 197)
+        self.assertEqual(slices['EvaluateScript'][159:168], [0, 1000, 0, 500, 500, 0, 500, 500, 0])
+        self.assertEqual(slices['FunctionCall'][159:168], [0, 0, 1000, 500, 500, 1000, 500, 500, 1000])
+        self.assertEqual(slices['EvaluateScript'][175:181], [500, 1000, 1000, 1000, 1000, 0])
+        self.assertEqual(sum(slices['EvaluateScript']) + sum(slices['FunctionCall']), 20000)
+        self.assertEqual(slices['Layout'][181], 500)
+        self.assertEqual(sum(self.cpu['slices']['20:2']['Paint']), 250)
+
+    def test_pyramid(self):
+        # 100us is finer than the slices and left out; a 10 ms level is 20 slices covering the 197 ms, each the sum of
+        # ten 1 ms slices, and only the runs of non-zero slices are kept
+        self.cpu = self.run_trace(slice_usecs=1000, pyramid_levels=[100, 10000])[1][2]
+        self.assertEqual([level['slice_usecs'] for level in self.cpu['pyramid']], [10000])
+        level = self.cpu['pyramid'][0]
+        self.assertEqual(level['slice_count'], 20)
+        slices = level['slices']['10:1']
+        self.assertEqual(slices['ParseHTML'], [[10, [9000, 10000]]])
+        self.assertEqual(slices['EvaluateScript'], [[16, [4000, 6000]]])
+        self.assertEqual(slices['FunctionCall'], [[16, [6000, 4000]]])
+        self.assertEqual(slices['Layout'], [[18, [500]]])
+
+
+class IntervalIndexTest(unittest.TestCase):
+    # Only intervals that aren't inside one already kept are added, and they replace the kept ones inside them
+
+    def test_nesting(self):
+        index = trace_parser.IntervalIndex()
+        index.add(10, 20)
+        index.add(30, 40)
+        self.assertTrue(index.contains(10, 20))
+        self.assertTrue(index.contains(12, 18))
+        self.assertTrue(index.contains(30, 35))
+        self.assertFalse(index.contains(15, 25))
+        self.assertFalse(index.contains(20, 30))
+        self.assertFalse(index.contains(5, 15))
+        # Overlapping, but neither holds the other: both stay
+        index.add(15, 25)
+        self.assertEqual((index.starts, index.ends), ([10, 15, 30], [20, 25, 40]))
+        # Holds the last two, not the first
+        index.add(12, 45)
+        self.assertEqual((index.starts, index.ends), ([10, 12], [20, 45]))
+        self.assertTrue(index.contains(30, 40))
+        index.add(0, 50)
+        self.assertEqual((index.starts, index.ends), ([0], [50]))
+
+
+class ProfileTest(TraceTestCase):
+    # A sampling profile of the fixture's script: main() calls f(), which calls itself, and a sample every ms from
+    # 160.5 ms. Each sample weighs the time to the next one, so the last weighs nothing.
+
+    def test_aggregation(self):
+        cat = 'disabled-by-default-v8.cpu_profile'
+
+        def node(node_id, function_name, parent=None, url='', line=-1):
+            node = {'id': node_id, 'callFrame': {'functionName': function_name, 'url': url, 'lineNumber': line}}
+            if parent is not None:
+                node['parent'] = parent
+            return node
+
+        nodes = [node(1, '(root)'), node(2, 'main', 1, SCRIPT, 1), node(3, 'f', 2, SCRIPT, 5),
+                 node(4, 'f', 3, SCRIPT, 5), node(5, '(program)', 1)]
+        self.write_trace(trace_events() + [
+            trace_event('Profile', T0 + 160000, 'P', cat=cat, id='0x1', args={'data': {'startTime': T0 + 160000}}),
+            trace_event('ProfileChunk', T0 + 170000, 'P', cat=cat, id='0x1', args={'data': {
+                'cpuProfile': {'nodes': nodes, 'samples': [2, 3, 4, 4, 5, 3]},
+                'timeDeltas': [500, 1000, 1000, 1000, 1000, 1000]}})])
+        result = self.run_trace()[1][0]
+        profile = [entry for entry in result if entry.get('id') == 'Profile'][0]
+        self.assertEqual((profile['samples'], profile['sampledTime']), (6, 5.0))
+        # f's total is its outer call only: 1 ms of its own and 2 ms in the recursive call
+        self.assertEqual([(function['functionName'], function['selfTime'], function['totalTime'])
+                          for function in profile['functions']], [('f', 3.0, 3.0), ('main', 1.0, 4.0)])
+        self.assertEqual(profile['urls'], [{'url': SCRIPT, 'selfTime': 4.0, 'totalTime': 4.0}])
+        scripting = [obj for entry in result if entry.get('id') == SCRIPT for obj in entry['objs']
+                     if obj['activityId'] == 'Scripting_0'][0]
+        self.assertEqual([(function['functionName'], function['selfTime']) for function in scripting['hotFunctions']],
+                         [('f', 3.0), ('main', 1.0)])
+
+
+class SpansTest(unittest.TestCase):
+    # Pairing B/E events per thread and name into spans, times in ms from the start of the trace
+
+    def setUp(self):
+        self.trace = trace_parser.Trace('test.trace', cache=False)
+        self.trace.start_time = T0
+        self.trace.cpu['main_thread'] = '10:1'
+
+    def spans(self):
+        return self.trace.BuildSpans([
+            trace_event('Layout', T0 + 1000, 'B'),
+            trace_event('Layout', T0 + 1500, 'B'),
+            trace_event('UpdateLayerTree', T0 + 1800, 'E'),
+            trace_event('Layout', T0 + 2000, 'E'),
+            trace_event('Paint', T0 + 2500, 'X', dur=500),
+            trace_event('UpdateLayerTree', T0 + 2600, 'B', pid=20, tid=2),
+            trace_event('Layout', T0 + 3000, 'E'),
+            trace_event('UpdateLayerTree', T0 + 3300, 'E', pid=20, tid=2),
+            trace_event('Paint', T0 + 4000, 'X', pid=20, tid=2, dur=250)])
+
+    def test_build_spans(self):
+        # The nested Layout makes one span from the outer B to its E, the E without a B is dropped, and the spans come
+        # in the order they complete
+        with self.assertLogs(level='WARNING'):
+            spans = self.spans()
+        self.assertEqual([[(event['name'], event['ph'], event['ts']) for event in span] for span in spans],
+                         [[('Paint', 'X', 2.5)], [('Layout', 'B', 1.0), ('Layout', 'E', 3.0)],
+                          [('UpdateLayerTree', 'B', 2.6), ('UpdateLayerTree', 'E', 3.3)], [('Paint', 'X', 4.0)]])
+        self.assertEqual((spans[0][0]['dur'], spans[3][0]['dur']), (0.5, 0.25))
+
+    def test_split_main_thread_spans(self):
+        # The main thread's spans are kept as they are, the others summed per thread and name
+        with self.assertLogs(level='WARNING'):
+            main_spans, off_thread = self.trace.SplitMainThreadSpans(self.spans())
+        self.assertEqual([span[0]['name'] for span in main_spans], ['Paint', 'Layout'])
+        self.assertEqual(off_thread, {'20:2': {'UpdateLayerTree': {'count': 1, 'duration': 0.7},
+                                               'Paint': {'count': 1, 'duration': 0.25}}})
+
+
+class ValidateTest(TraceTestCase):
+    # The browser's events come first in the fixture, as they do in the traces chrome_launcher.js writes
+
+    def test_main_document_found(self):
+        self.write_trace(trace_events())
+        self.assertEqual(trace_parser.Trace(self.path, cache=False).Validate(), (True, None))
+
+    def test_no_main_document_request(self):
+        # Every event is looked at: a trace whose renderer only starts after thousands of browser events is still
+        # rejected when it never requested the main document
+        noise = [trace_event('RunTask', T0 + i, 'X', cat='toplevel', pid=1, tid=5, dur=1) for i in range(6000)]
+        events = [event for event in trace_events() if event['name'] != 'ResourceSendRequest' or event['pid'] != 10]
+        self.write_trace(noise + events)
+        self.assertEqual(trace_parser.Trace(self.path, cache=False).Validate(),
+                         (False, 'No main document ResourceSendRequest'))
+        self.write_trace(noise + trace_events())
+        self.assertEqual(trace_parser.Trace(self.path, cache=False).Validate(), (True, None))
+
+    def test_no_main_document(self):
+        events = [event for event in trace_events() if event['name'] != 'ParseHTML']
+        self.write_trace(events, 'wrapped')
+        self.assertEqual(trace_parser.Trace(self.path, cache=False).Validate(),
+                         (False, 'No ParseHTML of the main document'))
+
+    def test_truncated(self):
+        self.write_trace(trace_events())
+        with open(self.path, 'r+') as f:
+            f.truncate(os.path.getsize(self.path) // 2)
+        trace = trace_parser.Trace(self.path, cache=False)
+        self.assertFalse(trace.Validate()[0])
+        self.assertTrue(trace.truncated)
+
+    def test_truncated_gzip(self):
+        # Past 4 MB compressed the gzip trailer of a cut off file can't be told from a real one, so only reading the
+        # data tells
+        padding = trace_event('RunTask', T0, 'X', cat='toplevel', pid=1, tid=5, dur=1,
+                              args={'padding': base64.b64encode(os.urandom(4500000)).decode('ascii')})
+        self.write_trace([padding] + trace_events())
+        with open(self.path, 'rb') as f:
+            data = gzip.compress(f.read())
+        with open(self.path, 'wb') as f:
+            f.write(data[:-100])
+        self.assertIsNone(trace_reader.ends_complete(self.path))
+        trace = trace_parser.Trace(self.path, cache=False)
+        self.assertFalse(trace.Validate()[0])
+        self.assertTrue(trace.truncated)
+
+
+class SalvageTest(TraceTestCase):
+
+    def cut_after(self, name, ph):
+        # Write the trace and cut it off in the middle of the element after the renderer's first name/ph event
+        events = trace_events()
+        self.write_trace(events)
+        index = [i for i, event in enumerate(events) if event['name'] == name and event['ph'] == ph][0]
+        with open(self.path) as f:
+            text = f.read()
+        end = text.index(json.dumps(json.dumps(events[index + 1])))
+        with open(self.path, 'w') as f:
+            f.write(text[:end + 20])
+
+    def salvage(self):
+        self.assertEqual(trace_parser.Trace(self.path, cache=False, salvage=True).Validate(), (True, None))
+        trace, result = self.run_trace(salvage=True)
+        self.assertTrue(trace.partial)
+        return result
+
+    def test_scripts_kept(self):
+        self.cut_after('Layout', 'X')
+        result, start_ts, cpu = self.salvage()
+        self.assertEqual(start_ts, T0)
+        self.assertIn('Scripting_0', [obj['activityId'] for entry in result if entry.get('id') == SCRIPT
+                                      for obj in entry['objs']])
+
+    def test_scripts_lost(self):
+        # The main document made it into the file but none of its scripts ran before the cut off
+        self.cut_after('ParseHTML', 'E')
+        self.assertEqual(self.salvage(), (False, False, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import copy
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import trace_reader
+
+
+class LazyTraceEventTest(unittest.TestCase):
+    # A lazy event has to give the same results as the plain dict it was cached from, whether or not its args were
+    # read yet
+
+    def setUp(self):
+        self.plain = {'pid': 10, 'tid': 1, 'ts': 1000, 'ph': 'X', 'cat': 'devtools.timeline', 'name': 'ParseHTML',
+                      'args': {'beginData': {'url': 'http://www.example.com/', 'startLine': 0}}}
+
+    def lazy(self):
+        fields = dict((key, value) for key, value in self.plain.items() if key != 'args')
+        return trace_reader.LazyTraceEvent(fields, json.dumps(self.plain['args']).encode('utf-8'))
+
+    def test_lookups(self):
+        event = self.lazy()
+        self.assertIn('args', event)
+        self.assertEqual(len(event), len(self.plain))
+        self.assertEqual(event.get('args'), self.plain['args'])
+        self.assertEqual(event['args'], self.plain['args'])
+        self.assertIsNone(event.get('dur'))
+
+    def test_views(self):
+        self.assertEqual(list(self.lazy()), list(self.plain))
+        self.assertEqual(list(self.lazy().keys()), list(self.plain.keys()))
+        self.assertEqual(list(self.lazy().values()), list(self.plain.values()))
+        self.assertEqual(list(self.lazy().items()), list(self.plain.items()))
+
+    def test_equality(self):
+        self.assertEqual(self.lazy(), self.plain)
+        self.assertEqual(self.plain, self.lazy())
+        self.assertEqual(self.lazy(), self.lazy())
+        self.assertFalse(self.lazy() != self.plain)
+        other = dict(self.plain, args={})
+        self.assertNotEqual(self.lazy(), other)
+
+    def test_copies(self):
+        self.assertEqual(dict(self.lazy()), self.plain)
+        self.assertEqual(self.lazy().copy(), self.plain)
+        self.assertEqual(copy.deepcopy(dict(self.lazy())), self.plain)
+        self.assertEqual(trace_reader.decoded(self.lazy()), self.plain)
+        self.assertIs(type(trace_reader.decoded(self.lazy())), dict)
+
+    def test_json(self):
+        self.assertEqual(json.dumps(self.lazy(), sort_keys=True), json.dumps(self.plain, sort_keys=True))
+        self.assertEqual(repr(self.lazy()), repr(self.plain))
+
+    def test_updates(self):
+        event = self.lazy()
+        event['args'] = {}
+        self.assertEqual(event['args'], {})
+        event = self.lazy()
+        self.assertEqual(event.pop('args'), self.plain['args'])
+        self.assertNotIn('args', event)
+        event = self.lazy()
+        del event['args']
+        self.assertNotIn('args', event)
+        self.assertEqual(len(event), len(self.plain) - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
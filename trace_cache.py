@@ -0,0 +1,207 @@
+"""
+Columnar binary cache of the trace events kept by Trace.IngestTrace().
+
+The cache lives next to the trace (<trace>.cache) and is laid out as:
+  - the magic bytes, the header length and a JSON header (versions, source file fingerprint, string table, column
+    index and the caller's info, e.g. whether the trace was salvaged)
+  - one 8 byte aligned column per field: ts, dur, tts, ph, pid, tid, the interned cat/name/id string ids and the
+    offsets into a blob of JSON encoded args. A number field holding floats as well as integers gets a column of
+    each (<field> and <field>_float) so every value comes back with the type it was read with.
+
+Columns are read straight out of a memory map so re-analyzing a trace only pays for building the event dicts; args
+stay raw JSON until a handler reads them (trace_reader.LazyTraceEvent).
+Only the args fields the analysis reads are stored; the cache is rebuilt whenever the trace's size, mtime or
+sampled digest, or the parser version changes.
+"""
+import array
+import hashlib
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+
+import trace_reader
+
+CACHE_SUFFIX = '.cache'
+CACHE_VERSION = 3
+MAGIC = b'WPXC'
+
+# Top level args fields used by the analysis stages
+ARGS_KEYS = ['data', 'beginData', 'params', 'source_type', 'layerTreeId']
+MISSING_INT = -(1 << 63)
+
+
+def cache_path(trace):
+    return trace + CACHE_SUFFIX
+
+
+def fingerprint(trace):
+    st = os.stat(trace)
+    digest = hashlib.sha1()
+    with open(trace, 'rb') as f:
+        digest.update(f.read(65536))
+        if st.st_size > 65536:
+            f.seek(max(65536, st.st_size - 65536))
+            digest.update(f.read())
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'digest': digest.hexdigest()}
+
+
+def prune_args(trace_event):
+    args = trace_event['args']
+    if trace_event['cat'].find('blink.user_timing') >= 0 or not isinstance(args, dict):
+        return args
+    pruned = {}
+    for key in ARGS_KEYS:
+        if key in args:
+            value = args[key]
+            # Only the innermost frame of a stack trace is ever looked at
+            if isinstance(value, dict) and isinstance(value.get('stackTrace'), list) and \
+                            len(value['stackTrace']) > 1:
+                value = dict(value)
+                value['stackTrace'] = value['stackTrace'][:1]
+            pruned[key] = value
+    return pruned
+
+
+def number_columns(name, values):
+    # Integers and floats are kept apart so the analysis output is unchanged (123 stays 123, not 123.0): the integers
+    # go to a column of int64s, the floats, if there are any, to a column of doubles next to it
+    columns = [(name, array.array('q', [v if type(v) is int else MISSING_INT for v in values]))]
+    if not all(v is None or type(v) is int for v in values):
+        columns.append((name + '_float', array.array('d', [float('nan') if v is None or type(v) is int else v
+                                                           for v in values])))
+    return columns
+
+
+def number_values(columns, name):
+    # The values of a field saved by number_columns(), None for the events that didn't have it
+    ints = columns[name].tolist()
+    if name + '_float' not in columns:
+        return [None if value == MISSING_INT else value for value in ints]
+    return [value if value != MISSING_INT else None if math.isnan(float_value) else float_value
+            for value, float_value in zip(ints, columns[name + '_float'].tolist())]
+
+
+def save(trace, parser_version, trace_events, info=None):
+    path = cache_path(trace)
+    tmp_path = path + '.tmp'
+    try:
+        strings = {}
+
+        def intern(value):
+            if value is None:
+                return -1
+            if value not in strings:
+                strings[value] = len(strings)
+            return strings[value]
+
+        blob = bytearray()
+        offsets = array.array('Q', [0])
+        for trace_event in trace_events:
+            # A zero length entry is an event without args, an empty dict still takes two bytes
+            if 'args' in trace_event:
+                blob += json.dumps(prune_args(trace_event), separators=(',', ':')).encode('utf-8')
+            offsets.append(len(blob))
+        columns = []
+        for field in ['ts', 'dur', 'tts', 'pid', 'tid']:
+            columns += number_columns(field, [e.get(field) for e in trace_events])
+        columns += [
+            ('ph', array.array('B', [ord(e['ph']) for e in trace_events])),
+            ('cat', array.array('i', [intern(e['cat']) for e in trace_events])),
+            ('name', array.array('i', [intern(e['name']) for e in trace_events])),
+            ('id', array.array('i', [intern(e.get('id')) for e in trace_events])),
+            ('args_offsets', offsets),
+            ('args', array.array('B', bytes(blob))),
+        ]
+        header = {'cache_version': CACHE_VERSION, 'parser_version': parser_version, 'source': fingerprint(trace),
+                  'count': len(trace_events), 'strings': sorted(strings, key=strings.get), 'columns': {},
+                  'info': info or {}}
+        # Column offsets depend on the header size, so lay them out relative to the end of the header first
+        position = 0
+        for name, column in columns:
+            header['columns'][name] = [column.typecode, position, len(column) * column.itemsize]
+            position += len(column) * column.itemsize
+            position += -position % 8
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = len(MAGIC) + 4 + len(header_bytes)
+        data_start += -data_start % 8
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<I', len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b'\0' * (data_start - f.tell()))
+            for name, column in columns:
+                column.tofile(f)
+                f.write(b'\0' * (-f.tell() % 8))
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.warning('Could not write trace cache ' + path + ': ' + str(e))
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+
+def load(trace, parser_version, partial=True):
+    """
+    Return the cached events of a trace as a list of event dicts along with the info dict they were saved with, or
+    None if there is no valid cache for it. With partial=False the cache of a salvaged, cut off trace isn't valid.
+    """
+    path = cache_path(trace)
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm[:len(MAGIC)] != MAGIC:
+                return None
+            header_len = struct.unpack_from('<I', mm, len(MAGIC))[0]
+            header = json.loads(mm[len(MAGIC) + 4:len(MAGIC) + 4 + header_len].decode('utf-8'))
+            if header['cache_version'] != CACHE_VERSION or header['parser_version'] != parser_version or \
+                            header['source'] != fingerprint(trace):
+                logging.info('Trace cache is stale: ' + path)
+                return None
+            if not partial and header['info'].get('partial'):
+                logging.info('Trace cache holds a salvaged partial trace: ' + path)
+                return None
+            data_start = len(MAGIC) + 4 + header_len
+            data_start += -data_start % 8
+            columns = {}
+            # build_events() copies everything out of the columns, their views have to be released before the map is
+            # closed
+            with memoryview(mm) as view:
+                try:
+                    for name, (typecode, offset, length) in header['columns'].items():
+                        columns[name] = view[data_start + offset:data_start + offset + length].cast(typecode)
+                    return build_events(header, columns), header['info']
+                finally:
+                    for column in columns.values():
+                        column.release()
+    except Exception as e:
+        logging.warning('Could not read trace cache ' + path + ': ' + str(e))
+        return None
+
+
+def build_events(header, columns):
+    # Every column is converted to a list in one go so the loop below only has to put the dicts together
+    strings = header['strings']
+    phases = [chr(i) for i in range(256)]
+    dur = number_values(columns, 'dur')
+    tts = number_values(columns, 'tts')
+    ids = [strings[i] if i >= 0 else None for i in columns['id'].tolist()]
+    offsets = columns['args_offsets'].tolist()
+    args = columns['args'].tobytes()
+    trace_events = []
+    for i, (pid, tid, ts, ph, cat, name) in enumerate(zip(number_values(columns, 'pid'), number_values(columns, 'tid'),
+                                                            number_values(columns, 'ts'), columns['ph'].tolist(),
+                                                            columns['cat'].tolist(), columns['name'].tolist())):
+        trace_event = {'pid': pid, 'tid': tid, 'ts': ts, 'ph': phases[ph], 'cat': strings[cat], 'name': strings[name]}
+        if offsets[i + 1] > offsets[i]:
+            trace_event = trace_reader.LazyTraceEvent(trace_event, args[offsets[i]:offsets[i + 1]])
+        if dur[i] is not None:
+            trace_event['dur'] = dur[i]
+        if tts[i] is not None:
+            trace_event['tts'] = tts[i]
+        if ids[i] is not None:
+            trace_event['id'] = ids[i]
+        trace_events.append(trace_event)
+    return trace_events
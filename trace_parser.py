@@ -19,18 +19,22 @@ Copyright (c) 2005-2010, AOL, LLC.
 
 All rights reserved.
 """
+import bisect
 import collections
 import copy
 import gzip
+import heapq
 import logging
 import coloredlogs
 import math
+import multiprocessing
 import os
 import time
 import sys
 import csv
-from urllib.parse import urldefrag
+from urllib.parse import urldefrag, urlparse
 import networkx as nx
+import numpy as np
 import matplotlib.pyplot as plt
 import tldextract
 
@@ -40,6 +44,8 @@ from collections import defaultdict
 
 from networkx.readwrite import json_graph
 
+import trace_cache
+import trace_reader
 import waterfall_draw
 
 try:
@@ -48,13 +54,159 @@ except:
     import json
 coloredlogs.install(level='INFO')
 
+# Bump whenever the set of events or fields kept by IngestTrace() changes so that stale trace caches are rebuilt
+PARSER_VERSION = 5
+
+# Requests made by the capture harness itself, not by the page
+HARNESS_URL = 'http://127.0.0.1:8888'
+# Fraction of a salvaged trace, by position in the file, whose processes bound the last consistent timestamp
+SALVAGE_TAIL = 0.1
+
+# Slice sizes (usecs) of the levels of cpu['pyramid'], levels finer than cpu['slice_usecs'] are left out
+PYRAMID_LEVELS = [100, 1000, 10000, 100000]
+
+# Main thread busy blocks longer than this (ms) are reported as long tasks
+LONG_TASK_MS = 50
+
+# Timeline events by the CPU category their self time is reported under, anything else counts as 'other'
+CPU_CATEGORY_EVENTS = collections.OrderedDict([
+    ('scripting', ['EvaluateScript', 'FunctionCall', 'V8.Execute', 'v8.run', 'v8.callFunction', 'TimerFire',
+                   'EventDispatch', 'FireAnimationFrame', 'RunMicrotasks', 'XHRReadyStateChange', 'XHRLoad']),
+    ('compile', ['v8.compile', 'v8.parseOnBackground', 'v8.compileModule', 'V8.CompileScript', 'V8.CompileLazy',
+                 'V8.ParseLazy']),
+    ('gc', ['MinorGC', 'MajorGC', 'GCEvent', 'V8.GCScavenger', 'V8.GCIncrementalMarking', 'V8.GCFinalizeMC',
+            'V8.GCCompactor', 'BlinkGC.AtomicPhase', 'ThreadState::performIdleLazySweep']),
+    ('loading', ['ParseHTML', 'ParseAuthorStyleSheet']),
+    ('rendering', ['Layout', 'UpdateLayerTree', 'UpdateLayoutTree', 'RecalculateStyles', 'ScheduleStyleRecalculation',
+                   'InvalidateLayout', 'HitTest']),
+    ('painting', ['Paint', 'CompositeLayers', 'UpdateLayer', 'PaintImage', 'Decode Image', 'ImageDecodeTask',
+                  'RasterTask'])])
+CPU_CATEGORIES = list(CPU_CATEGORY_EVENTS) + ['other']
+# The phases a Scripting activity's main thread time is split into, and the CPU category each one is read from
+SCRIPT_PHASES = [('compile', 'compile'), ('execute', 'scripting'), ('gc', 'gc')]
+CPU_CATEGORY_OF = {name: CPU_CATEGORIES.index(category) for category, names in CPU_CATEGORY_EVENTS.items()
+                   for name in names}
+
+# The phases a request's time is split into, in the order they happen
+NETWORK_PHASES = ['queueing', 'dns', 'connect', 'tls', 'request', 'ttfb', 'download']
+
+# Width of the page-wide bandwidth timeline buckets, in ms
+BANDWIDTH_BUCKET_MS = 10
+
+# Analysis stages a trace event can be routed to
+TIMELINE = 1
+USER_TIMING = 2
+LOADING = 4
+PAINTING = 8
+RENDERING = 16
+NETWORK = 32
+NETLOG = 64
+PROFILE = 128
+
+# Every category ClassifyTraceEvent routes to a stage contains one of these
+ROUTED_CATEGORIES = ['devtools.timeline', 'blink.user_timing', 'netlog', 'disabled-by-default-v8.cpu_profile']
+
+# Number of functions listed in the Profile output entry, and per Scripting activity
+PROFILE_TOP_FUNCTIONS = 100
+PROFILE_HOT_FUNCTIONS = 5
+# Nodes V8 adds to a profile for time not spent in a function, left out of both lists
+PROFILE_META_NODES = {'(root)', '(program)', '(idle)', '(garbage collector)'}
+
+# Timeline events whose args are read by ProcessTimelineTraceEvent, args of the others are dropped on ingestion
+TIMELINE_ARGS_EVENTS = ['ResourceSendRequest', 'EvaluateScript', 'v8.compile', 'v8.parseOnBackground', 'FunctionCall']
+
+
+class TimelineEvent():
+    """
+    A node of the per-thread timeline tree: thread, interned event name, start and end ts, child events and the url
+    of the script it ran, if any.
+    """
+    __slots__ = ('t', 'n', 's', 'e', 'c', 'js')
+
+    def __init__(self, thread, name, start):
+        self.t = thread
+        self.n = name
+        self.s = start
+        self.e = None
+        self.c = None
+        self.js = None
+
+
+def sparse_runs(values):
+    # [[index of the first slice, [values...]], ...] for every run of non-zero values of a 1-D array
+    nonzero = np.concatenate(([False], values != 0, [False]))
+    edges = np.flatnonzero(nonzero[1:] != nonzero[:-1])
+    return [[int(start), values[start:end].tolist()] for start, end in zip(edges[0::2], edges[1::2])]
+
+
+def merge_intervals(intervals, touching=True):
+    # Merge [start, end] intervals sorted by start into disjoint ones. With touching=False an interval starting right
+    # where the previous one ended is kept apart.
+    merged = []
+    for start, end in intervals:
+        if len(merged) and (start < merged[-1][1] or (touching and start == merged[-1][1])):
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def http2_request_url(headers):
+    # The URL of an HTTP/2 request from its pseudo-headers, sent as a dict or as a list of "name: value" strings
+    if isinstance(headers, list):
+        headers = dict((header[:header.find(': ', 1)], header[header.find(': ', 1) + 2:]) for header in headers
+                       if header.find(': ', 1) > 0)
+    if not isinstance(headers, dict) or ':authority' not in headers or ':path' not in headers:
+        return None
+    return headers.get(':scheme', 'https') + '://' + headers[':authority'] + headers[':path']
+
+
+class IntervalIndex():
+    """
+    The maximal intervals of a set (none inside another) sorted by start. Their ends are then sorted as well, so
+    finding an interval that contains a new one, or the ones a new one contains, is a binary search.
+    """
+    __slots__ = ('starts', 'ends')
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def contains(self, start, end):
+        # The interval starting last at or before start is also the one ending last among them
+        i = bisect.bisect_right(self.starts, start) - 1
+        return i >= 0 and self.ends[i] >= end
+
+    def add(self, start, end):
+        # Replace the intervals the new one contains, they are the ones from its start on that end before it
+        i = bisect.bisect_left(self.starts, start)
+        j = bisect.bisect_right(self.ends, end, i)
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
 
 ########################################################################################################################
 #   Trace processing
 ########################################################################################################################
 class Trace():
-    def __init__(self, trace):
+    def __init__(self, trace, cache=True, workers=1, prune_unrouted=True, salvage=False, slice_usecs=None,
+                 pyramid_levels=PYRAMID_LEVELS):
         self.trace = trace
+        self.cache = cache
+        self.workers = workers
+        # Analyze a cut off trace up to its last consistent timestamp instead of failing, self.partial tells if it was
+        self.salvage = salvage
+        self.partial = False
+        # Set by Validate() when the trace was found to be cut off
+        self.truncated = False
+        self.partial_cutoff = None
+        self.process_ends = {}
+        self.events_read = 0
+        # Skip the events whose category no stage routes as early as the layout allows (see KeepTraceItem). It never
+        # changes the results, prune_unrouted=False is only there to compare against a full read.
+        self.prune_unrouted = prune_unrouted
+        self.ingested = False
+        self.dispatch = {}
         self.thread_stack = {}
         self.ignore_threads = {}
         self.threads = {}
@@ -62,6 +214,27 @@ class Trace():
         self.event_names = {}
         self.event_name_lookup = {}
         self.scripts = None
+        self.script_index = {}
+        self.script_self_time = {}
+        self.script_execution = {}
+        self.main_thread_activity = None
+        self.main_thread_segments = []
+        self.activity_cpu = {}
+        self.network_http2 = {}
+        self.netlog_url_requests = {}
+        self.netlog_stream_jobs = {}
+        self.network_phases = {}
+        self.network_phase_spans = {}
+        self.network_reused = set()
+        self.network_setup = {}
+        self.received_data = []
+        self.redirect_hops = {}
+        self.critical_path_redirect_time = 0
+        self.network_bytes = {}
+        self.bandwidth = None
+        self.critical_path_networking = {}
+        self.main_thread_cpu = None
+        self.critical_path_scripting = {}
         self.scripts_list = []
         self.scripts_lookup_url = {}
         self.scripts_lookup_id = {}
@@ -70,6 +243,9 @@ class Trace():
         self.loading_trace_events = []
         self.network_trace_events = []
         self.netlog_trace_events = []
+        self.profile_trace_events = []
+        self.profile = None
+        self.activity_hot_functions = {}
         self.painting_trace_events = []
         self.rendering_trace_events = []
         self.networks = {}
@@ -82,6 +258,9 @@ class Trace():
         self.loading_lookup_id = {}
         self.painting = {}
         self.painting_list = []
+        # Rendering/painting spans off the main thread (compositor, raster, GPU) are only summed up per thread
+        self.off_thread_rendering = {}
+        self.off_thread_painting = {}
         self.rendering = {}
         self.rendering_list = []
         self.ordered = {}
@@ -99,6 +278,11 @@ class Trace():
         self.computationTime = 0
         self.networkingTime = 0
         self.cpu = {'main_thread': None}
+        # Finest CPU slice size, picked from the length of the trace unless given
+        self.slice_usecs = slice_usecs
+        self.pyramid_levels = pyramid_levels
+        self.slice_rows = {}
+        self.slice_matrix = {}
         self.feature_usage = None
         self.feature_usage_start_time = None
         self.netlog = {'bytes_in': 0, 'bytes_out': 0, 'ssl_bytes_in': 0, 'ssl_bytes_out': 0}
@@ -139,6 +323,15 @@ class Trace():
         if self.scripts is not None:
             self.WriteJson(file, self.scripts)
 
+    def WriteScriptExecution(self, file):
+        self.WriteJson(file, self.script_execution)
+
+    def WriteMainThreadActivity(self, file):
+        self.WriteJson(file, self.main_thread_activity)
+
+    def WriteProfile(self, file):
+        self.WriteJson(file, self.profile)
+
     def WriteFeatureUsage(self, file):
         self.WriteJson(file, self.feature_usage)
 
@@ -167,6 +360,25 @@ class Trace():
             result.update(dictionary)
         return result
 
+    def ActivityDetails(self, _nodeId):
+        # What the later analysis stages know about an activity, to merge into its output entry: its main thread CPU
+        # breakdown (ms per category), the functions the sampling profiler saw most in it, and the HTTP/2 stream,
+        # phases and byte arrival of a request
+        _details = {}
+        if _nodeId in self.activity_cpu:
+            _details['cpu'] = self.activity_cpu[_nodeId]
+            if _nodeId.startswith('Scripting'):
+                _details['phases'] = {phase: self.activity_cpu[_nodeId][category] for phase, category in SCRIPT_PHASES}
+        if _nodeId in self.activity_hot_functions:
+            _details['hotFunctions'] = self.activity_hot_functions[_nodeId]
+        if _nodeId in self.network_http2:
+            _details['http2'] = self.network_http2[_nodeId]
+        if _nodeId in self.network_phases:
+            _details['phases'] = self.network_phases[_nodeId]
+        if _nodeId in self.network_bytes:
+            _details['bytesReceived'] = self.network_bytes[_nodeId]
+        return _details
+
     def WriteOutputlog_new(self, file=None, mode='main'):
         for _index, _value in enumerate(self.ordered):
             _url_group = _value[0]
@@ -177,16 +389,18 @@ class Trace():
                 _tmp_merged_dict = {}
                 if _nodeId.startswith('Network'):
                     _tmp_dict['activityId'] = _nodeId
-                    _tmp_merged_dict = self.merge_dicts(_tmp_dict, self.networks_lookup_id[_nodeId])
+                    _tmp_merged_dict = self.merge_dicts(_tmp_dict, self.networks_lookup_id[_nodeId],
+                                                        self.ActivityDetails(_nodeId))
                     _tmp_list.append(_tmp_merged_dict)
 
                 elif _nodeId.startswith('Load'):
                     _tmp_dict['activityId'] = _nodeId
-                    _tmp_merged_dict = self.merge_dicts(_tmp_dict, self.loading[_nodeId])
+                    _tmp_merged_dict = self.merge_dicts(_tmp_dict, self.loading[_nodeId], self.ActivityDetails(_nodeId))
                     _tmp_list.append(_tmp_merged_dict)
                 elif _nodeId.startswith('Script'):
                     _tmp_dict['activityId'] = _nodeId
-                    _tmp_merged_dict = self.merge_dicts(_tmp_dict, self.scripts_lookup_id[_nodeId])
+                    _tmp_merged_dict = self.merge_dicts(_tmp_dict, self.scripts_lookup_id[_nodeId],
+                                                        self.ActivityDetails(_nodeId))
                     _tmp_list.append(_tmp_merged_dict)
             self.output.append({'id': _url_group, 'objs': _tmp_list})
 
@@ -195,7 +409,7 @@ class Trace():
             _nodeId = _value[0]
             _tmp_dict['activityId'] = _nodeId
             _nodeData = _value[1]
-            _tmp_merged_dict = self.merge_dicts(_tmp_dict, _nodeData)
+            _tmp_merged_dict = self.merge_dicts(_tmp_dict, _nodeData, self.ActivityDetails(_nodeId))
             _tmp_r_list.append(_tmp_merged_dict)
 
         _tmp_p_list = []
@@ -203,24 +417,46 @@ class Trace():
             _nodeId = _value[0]
             _tmp_dict['activityId'] = _nodeId
             _nodeData = _value[1]
-            _tmp_merged_dict = self.merge_dicts(_tmp_dict, _nodeData)
+            _tmp_merged_dict = self.merge_dicts(_tmp_dict, _nodeData, self.ActivityDetails(_nodeId))
             _tmp_p_list.append(_tmp_merged_dict)
 
-        _tmp_rendering = {'id': 'Rendering', 'objs': _tmp_r_list}
-        _tmp_painting = {'id': 'Painting', 'objs': _tmp_p_list}
+        _tmp_rendering = {'id': 'Rendering', 'objs': _tmp_r_list, 'offThread': self.off_thread_rendering}
+        _tmp_painting = {'id': 'Painting', 'objs': _tmp_p_list, 'offThread': self.off_thread_painting}
         _tmp_deps = {'id': 'Deps', 'objs': self.deps}
 
         _tmp_netlog = {'id': 'Netlog', 'dns': self.netlog['dns'], 'sockets': self.netlog['sockets'],
                        'dnsTime': self.netlog['dnsTime'], 'sockets_bytes_in': self.netlog['bytes_in'],
                        'sockets_bytes_out': self.netlog['bytes_out'],
                        'ssl_sockets_bytes_out': self.netlog['ssl_bytes_out'],
-                       'ssl_sockets_bytes_in': self.netlog['ssl_bytes_in']}
-        _tmp_critical_path = {'criticalPath': self.critical_path, 'networkingTime': self.networkingTime, 'computationTime': self.computationTime}
+                       'ssl_sockets_bytes_in': self.netlog['ssl_bytes_in'], 'http2': self.netlog['http2'],
+                       'connections': self.netlog['connections']}
+        _tmp_script_execution = {'id': 'ScriptExecution', 'mainThread': self.cpu['main_thread'],
+                                 'objs': [self.merge_dicts({'thread': _thread, 'url': _script}, _execution)
+                                          for _thread in self.script_execution
+                                          for _script, _execution in self.script_execution[_thread].items()]}
+        _tmp_main_thread = self.merge_dicts({'id': 'MainThread', 'thread': self.cpu['main_thread']},
+                                            self.main_thread_activity or {})
+        _tmp_profile = {'id': 'Profile'}
+        if self.profile is not None:
+            _tmp_profile['samples'] = self.profile['samples']
+            _tmp_profile['sampledTime'] = self.profile['sampledTime']
+            _tmp_profile['functions'] = self.profile['functions'][:PROFILE_TOP_FUNCTIONS]
+            _tmp_profile['urls'] = self.profile['urls']
+        _tmp_bandwidth = self.merge_dicts({'id': 'Bandwidth'}, self.bandwidth or {})
+        _tmp_critical_path = {'criticalPath': self.critical_path, 'networkingTime': self.networkingTime,
+                              'computationTime': self.computationTime,
+                              'scriptingPhases': self.critical_path_scripting,
+                              'networkingPhases': self.critical_path_networking,
+                              'redirectTime': self.critical_path_redirect_time}
 
         self.output.append(_tmp_rendering)
         self.output.append(_tmp_painting)
         self.output.append(_tmp_deps)
         self.output.append(_tmp_netlog)
+        self.output.append(_tmp_script_execution)
+        self.output.append(_tmp_main_thread)
+        self.output.append(_tmp_profile)
+        self.output.append(_tmp_bandwidth)
         self.output.append(_tmp_critical_path)
         if mode == 'main':
             self.WriteJson(file, self.output)
@@ -261,66 +497,7 @@ class Trace():
     #   Top-level processing
     ########################################################################################################################
     def Process_Loading_Render_Painting_Network(self):
-        """f = None
-        try:
-            file_name, ext = os.path.splitext(trace)
-            if ext.lower() == '.gz':
-                f = gzip.open(trace, 'rb')
-            else:
-                f = open(trace, 'r')
-            for line in f:
-                try:
-                    trace_event = json.loads(line.strip("[]\r\n\t ,"))
-                    cat = trace_event['cat']
-                    name = trace_event['name']
-                    if (cat == 'devtools.timeline' and name == 'ParseHTML') or (
-                                    cat == 'blink,devtools.timeline' and name == 'ParseAuthorStyleSheet'):
-                        self.loading_trace_events.append(trace_event)
-                    if (cat == 'disabled-by-default-devtools.timeline' or cat.find('devtools.timeline') >= 0) \
-                            and name in ['CompositeLayers', 'Paint']:
-                        self.painting_trace_events.append(trace_event)
-                    if (cat == 'devtools.timeline' or cat.find('devtools.timeline') >= 0) \
-                            and name in ['Layout', 'UpdateLayerTree', 'HitTest', 'RecalculateStyles']:
-                        self.rendering_trace_events.append(trace_event)
-                    if cat == 'devtools.timeline' and \
-                            (name in ['ResourceSendRequest', 'ResourceReceiveResponse', 'ResourceReceivedData',
-                                      'ResourceFinish']):
-                        self.network_trace_events.append(trace_event)
-                except:
-                    raise
-        except:
-            logging.critical("Error processing trace " + trace)
-            raise
-
-        if f is not None:
-            f.close()"""
-        with open(self.trace, 'r') as content_file:
-            content = content_file.read()
-        trace_events = json.loads(content)
-        for trace_event in trace_events:
-            trace_event = json.loads(trace_event)
-            try:
-                cat = trace_event['cat']
-                name = trace_event['name']
-                if (cat == 'devtools.timeline' and name == 'ParseHTML') or (
-                                cat == 'blink,devtools.timeline' and name == 'ParseAuthorStyleSheet'):
-                    self.loading_trace_events.append(trace_event)
-                ### removed to speed up plotting tests
-                if (cat == 'disabled-by-default-devtools.timeline' or cat.find('devtools.timeline') >= 0) \
-                        and name in ['CompositeLayers', 'Paint']:
-                    self.painting_trace_events.append(trace_event)
-                if (cat == 'devtools.timeline' or cat.find('devtools.timeline') >= 0) \
-                        and name in ['Layout', 'UpdateLayerTree', 'HitTest', 'RecalculateStyles']:
-                    self.rendering_trace_events.append(trace_event)
-                if cat == 'devtools.timeline' and \
-                        (name in ['ResourceSendRequest', 'ResourceReceiveResponse', 'ResourceReceivedData',
-                                  'ResourceFinish']):
-                    self.network_trace_events.append(trace_event)
-                if cat == 'netlog':
-                    self.netlog_trace_events.append(trace_event)
-            except:
-                raise
-
+        self.IngestTrace()
         self.network_trace_events.sort(key=lambda my_trace_event: my_trace_event['ts'])
         self.rendering_trace_events.sort(key=lambda my_trace_event: my_trace_event['ts'])
         self.loading_trace_events.sort(key=lambda my_trace_event: my_trace_event['ts'])
@@ -341,57 +518,250 @@ class Trace():
         return _trace
 
     def Process(self):
-        with open(self.trace, 'r') as content_file:
-            content = content_file.read()
-        trace_events = json.loads(content)
-        for trace_event in trace_events:
-            trace_event = json.loads(trace_event)
-            try:
-                self.FilterTraceEvent(trace_event)
-            except:
-                raise
-        """f = None
-        line_mode = False
-        self.__init__()
-        try:
-            file_name, ext = os.path.splitext(trace)
-            if ext.lower() == '.gz':
-                f = gzip.open(trace, 'rb')
-            else:
-                f = open(trace, 'r')
-            for line in f:
-                try:
-                    trace_event = json.loads(line.strip("[]\r\n\t ,"))
-                    if not line_mode and 'traceEvents' in trace_event:
-                        for sub_event in trace_event['traceEvents']:
-                            self.FilterTraceEvent(sub_event)
-                    else:
-                        line_mode = True
-                        self.FilterTraceEvent(trace_event)
-                except:
-                    pass
-        except:
-            logging.critical("Error processing trace " + trace)
-
-        if f is not None:
-            f.close()"""
-
+        self.IngestTrace()
         self.ProcessTraceEvents()
 
-    def FilterTraceEvent(self, trace_event):
-        cat = trace_event['cat']
-        if cat == 'toplevel' or cat == 'ipc,toplevel':
+    def Validate(self):
+        # Cheap check, before the full analysis, that a trace is usable: the file must not be cut off (only its tail
+        # is looked at, compressed data isn't decompressed for it) and it has to hold a non-harness ResourceSendRequest
+        # and the ParseHTML of the same url (the main document). The whole file is scanned as the renderer's events
+        # often come after the browser's and GPU's, but only those two events are decoded. When the tail can't tell
+        # (a large gzip trace) the scan goes on to the end of the file to find out. In salvage mode a cut off trace
+        # is fine as long as those events made it into the file.
+        # Returns (ok, reason); self.truncated tells if it failed for being cut off.
+        found = False
+        try:
+            complete = True if self.salvage else trace_reader.ends_complete(self.trace)
+            if complete is False:
+                self.truncated = True
+                return False, 'Trace is truncated, tracing did not complete'
+            request_urls = set()
+            parse_urls = set()
+            with trace_reader.open_trace(self.trace) as content_file:
+                for item in trace_reader.iter_trace_items(content_file):
+                    if isinstance(item, str):
+                        if 'ResourceSendRequest' not in item and 'ParseHTML' not in item:
+                            continue
+                        item = json.loads(item)
+                    args = item.get('args')
+                    if found or not isinstance(args, dict) or item.get('cat', '').find('devtools.timeline') < 0:
+                        continue
+                    if item.get('name') == 'ResourceSendRequest':
+                        url = args.get('data', {}).get('url', '')
+                        if url.startswith(HARNESS_URL):
+                            continue
+                        request_urls.add(url)
+                        found = url in parse_urls
+                    elif item.get('name') == 'ParseHTML' and item.get('ph') == 'B':
+                        url = args.get('beginData', {}).get('url')
+                        parse_urls.add(url)
+                        found = url in request_urls
+                    if found and complete:
+                        return True, None
+        except trace_reader.TruncatedTrace as e:
+            if not self.salvage:
+                self.truncated = True
+                return False, 'Unreadable trace: ' + str(e)
+        except Exception as e:
+            return False, 'Unreadable trace: ' + str(e)
+        if found:
+            return True, None
+        if not request_urls:
+            return False, 'No main document ResourceSendRequest'
+        return False, 'No ParseHTML of the main document'
+
+    def ReadTraceEvents(self, prune=False):
+        # Stream the events out of the (possibly compressed) file instead of loading it as a whole
+        keep_item = self.KeepTraceItem if prune else None
+        on_truncated = self.MarkPartial if self.salvage else None
+        with trace_reader.open_trace(self.trace) as content_file:
+            for trace_event in trace_reader.iter_trace_events(content_file, keep_item=keep_item,
+                                                              on_truncated=on_truncated):
+                yield trace_event
+
+    def MarkPartial(self, reason):
+        logging.warning('Partial trace, analyzing the events before the truncation: ' + str(self.trace) + ': ' + reason)
+        self.partial = True
+
+    def TrackProcessEnds(self, trace_events):
+        # Salvage mode: remember the last timestamp of every process and where in the file its events were last seen
+        process_ends = self.process_ends
+        index = 0
+        for trace_event in trace_events:
+            index += 1
+            if trace_event['ph'] != 'M':
+                ts = trace_event.get('ts', 0)
+                end = process_ends.get(trace_event['pid'])
+                if end is None:
+                    process_ends[trace_event['pid']] = [ts, index]
+                else:
+                    if ts > end[0]:
+                        end[0] = ts
+                    end[1] = index
+            yield trace_event
+        self.events_read = index
+
+    def SalvageCutoff(self):
+        # Processes flush their trace buffers in turn, so each process that was still being written when the file was
+        # cut can be missing a different amount of its tail. Everything up to the earliest of their last timestamps
+        # is consistent. Processes that went quiet well before the end of the file don't bound it.
+        tail_start = self.events_read - max(1, int(self.events_read * SALVAGE_TAIL))
+        ends = [ts for ts, index in self.process_ends.values() if index > tail_start]
+        if not ends:
+            return None
+        return min(ends)
+
+    def DropAfterCutoff(self, trace_events):
+        return [trace_event for trace_event in trace_events if trace_event['ts'] <= self.partial_cutoff]
+
+    def KeepTraceItem(self, item):
+        # prune_unrouted ingestion, run on each raw element: skip the JSON encoded events (array-of-strings layout, and
+        # the lines of a one-event-per-line trace parsed in parallel) whose text doesn't even mention a category
+        # ClassifyTraceEvent routes, before they are decoded. Elements that are already objects are dropped on their
+        # category, before they are routed or sent back from a worker. Events of every process are still read, the
+        # ones any stage routes are kept, so the results don't change.
+        if isinstance(item, dict):
+            item = item.get('cat')
+        if not isinstance(item, str):
+            return True
+        for category in ROUTED_CATEGORIES:
+            if category in item:
+                return True
+        return False
+
+    def ReadTraceEventsParallel(self, prune=False):
+        # Decode and filter byte ranges of the trace in a process pool. The events each worker kept are yielded in
+        # file order so routing them here gives exactly the same buckets as the serial path.
+        split = trace_reader.split_trace(self.trace, self.workers * 4)
+        if split is None:
+            logging.info('Trace can not be split, parsing it serially: ' + str(self.trace))
+            for trace_event in self.ReadTraceEvents(prune):
+                yield trace_event
+            return
+        layout, ranges = split
+        jobs = [(self.trace, start, end, layout, prune) for start, end in ranges]
+        with multiprocessing.Pool(self.workers) as pool:
+            for kept_events in pool.imap(parse_trace_chunk, jobs):
+                for trace_event in kept_events:
+                    yield trace_event
+
+    def IngestTrace(self):
+        # Decode every event exactly once and hand it to all of the consumers: the timeline filter and the
+        # loading/painting/rendering/network/netlog buckets.
+        if self.ingested:
             return
-        if cat == 'devtools.timeline' or \
-                        cat.find('devtools.timeline') >= 0 or \
-                        cat.find('blink.feature_usage') >= 0 or \
-                        cat.find('blink.user_timing') >= 0:
-            self.trace_events.append(trace_event)
+        if self.cache:
+            # A salvaged cache stands for a truncated trace, which has to be rejected again without salvage
+            cached = trace_cache.load(self.trace, PARSER_VERSION, partial=self.salvage)
+            if cached is not None:
+                cached_events, info = cached
+                logging.info('Using trace cache: ' + trace_cache.cache_path(self.trace))
+                if info.get('partial'):
+                    self.MarkPartial('salvaged when the cache was built')
+                    self.partial_cutoff = info['partial_cutoff']
+                for trace_event in cached_events:
+                    self.RouteTraceEvent(trace_event)
+                self.ingested = True
+                return
+        kept_events = []
+        # A cut off trace can not be split into chunks, salvage it serially
+        salvage = self.salvage and trace_reader.ends_complete(self.trace) is not True
+        # The salvage cutoff is found from the last event of every process, routed or not, so nothing is pruned then
+        prune = self.prune_unrouted and not salvage
+        if self.workers > 1 and not salvage:
+            trace_events = self.ReadTraceEventsParallel(prune)
+        else:
+            trace_events = self.ReadTraceEvents(prune)
+        if salvage:
+            trace_events = self.TrackProcessEnds(trace_events)
+        for trace_event in trace_events:
+            if self.RouteTraceEvent(trace_event) and self.cache:
+                kept_events.append(trace_event)
+        info = {}
+        if self.partial:
+            self.partial_cutoff = self.SalvageCutoff()
+            if self.partial_cutoff is not None:
+                logging.warning('Dropping the events after ' + str(self.partial_cutoff) + ' in the partial trace')
+                for bucket in [self.trace_events, self.loading_trace_events, self.painting_trace_events,
+                               self.rendering_trace_events, self.network_trace_events, self.netlog_trace_events,
+                               self.profile_trace_events]:
+                    bucket[:] = self.DropAfterCutoff(bucket)
+                kept_events = self.DropAfterCutoff(kept_events)
+            info = {'partial': True, 'partial_cutoff': self.partial_cutoff}
+        if self.cache:
+            trace_cache.save(self.trace, PARSER_VERSION, kept_events, info)
+        self.ingested = True
+
+    def RouteTraceEvent(self, trace_event):
+        # Every distinct (cat, name) pair is classified once, after that routing an event is a single dict lookup.
+        # Returns True if any stage kept the event.
+        key = (trace_event['cat'], trace_event['name'])
+        route = self.dispatch.get(key)
+        if route is None:
+            route = self.dispatch[key] = self.BuildRoute(*key)
+        stages, buckets, keep_args = route
+        if not buckets:
+            return False
+        # Don't hold on to args no stage will read. Cached events never carry them as they are saved after this.
+        if not keep_args:
+            trace_event.pop('args', None)
+        for bucket in buckets:
+            bucket.append(trace_event)
+        return True
+
+    def BuildRoute(self, cat, name):
+        stages = self.ClassifyTraceEvent(cat, name)
+        buckets = []
+        if stages & (TIMELINE | USER_TIMING):
+            buckets.append(self.trace_events)
+        if stages & LOADING:
+            buckets.append(self.loading_trace_events)
+        if stages & PAINTING:
+            buckets.append(self.painting_trace_events)
+        if stages & RENDERING:
+            buckets.append(self.rendering_trace_events)
+        if stages & NETWORK:
+            buckets.append(self.network_trace_events)
+        if stages & NETLOG:
+            buckets.append(self.netlog_trace_events)
+        if stages & PROFILE:
+            buckets.append(self.profile_trace_events)
+        keep_args = bool(stages & (USER_TIMING | LOADING | PAINTING | NETWORK | NETLOG | PROFILE)) or \
+                    (stages & TIMELINE and name in TIMELINE_ARGS_EVENTS)
+        return stages, tuple(buckets), keep_args
+
+    def ClassifyTraceEvent(self, cat, name):
+        stages = 0
+        if cat != 'toplevel' and cat != 'ipc,toplevel':
+            if cat.find('devtools.timeline') >= 0:
+                stages |= TIMELINE
+            elif cat.find('blink.user_timing') >= 0:
+                stages |= USER_TIMING
+        if (cat == 'devtools.timeline' and name == 'ParseHTML') or (
+                        cat == 'blink,devtools.timeline' and name == 'ParseAuthorStyleSheet'):
+            stages |= LOADING
+        if cat.find('devtools.timeline') >= 0 and name in ['CompositeLayers', 'Paint']:
+            stages |= PAINTING
+        if cat.find('devtools.timeline') >= 0 and \
+                name in ['Layout', 'UpdateLayerTree', 'HitTest', 'RecalculateStyles']:
+            stages |= RENDERING
+        if cat == 'devtools.timeline' and \
+                (name in ['ResourceSendRequest', 'ResourceReceiveResponse', 'ResourceReceivedData',
+                          'ResourceFinish']):
+            stages |= NETWORK
+        if cat == 'netlog':
+            stages |= NETLOG
+        # Also recorded under disabled-by-default-v8.cpu_profiler and disabled-by-default-v8.cpu_profiler.hires
+        if cat.startswith('disabled-by-default-v8.cpu_profile') and name in ['Profile', 'ProfileChunk']:
+            stages |= PROFILE
+        return stages
 
     def ProcessTraceEvents(self):
-        # sort the raw trace events by timestamp and then process them
+        # sort the raw trace events by timestamp and then process them. Chrome writes a complete event after the ones
+        # nested in it, so among the ones starting together the longest goes first to be their parent; B/E events
+        # keep their file order ahead of them.
         if len(self.trace_events):
-            self.trace_events.sort(key=lambda trace_event: trace_event['ts'])
+            self.trace_events.sort(key=lambda trace_event: (trace_event['ts'], -trace_event.get('dur', float('inf'))))
             for trace_event in self.trace_events:
                 self.ProcessTraceEvent(trace_event)
             self.trace_events = []
@@ -400,16 +770,11 @@ class Trace():
         self.ProcessTimelineEvents()
 
     def ProcessTraceEvent(self, trace_event):
-        cat = trace_event['cat']
-        if cat == 'devtools.timeline' or cat.find('devtools.timeline') >= 0:
+        stages = self.dispatch[(trace_event['cat'], trace_event['name'])][0]
+        if stages & TIMELINE:
             self.ProcessTimelineTraceEvent(trace_event)
-            # elif cat.find('blink.feature_usage') >= 0:
-            # self.ProcessFeatureUsageEvent(trace_event)
-        elif cat.find('blink.user_timing') >= 0:
-            self.user_timing.append(trace_event)
-            # Netlog support is still in progress
-            # elif cat.find('netlog') >= 0:
-            #  self.ProcessNetlogEvent(trace_event)
+        elif stages & USER_TIMING:
+            self.user_timing.append(trace_reader.decoded(trace_event))
 
     ########################################################################################################################
     #   Timeline
@@ -451,8 +816,13 @@ class Trace():
                         self.ProcessNetlogSslSocketEvent(trace_event)
                     else:
                         self.ProcessNetlogSocketEvent(trace_event)
-                """if trace_event['args']['source_type'] == 'HTTP2_SESSION':
-                    self.ProcessNetlogHTTP2SessionEvent(trace_event)"""
+                    self.ProcessNetlogConnectionEvent(trace_event)
+                if trace_event['args']['source_type'] == 'URL_REQUEST':
+                    self.ProcessNetlogURLRequestEvent(trace_event)
+                if trace_event['args']['source_type'] == 'HTTP_STREAM_JOB':
+                    self.ProcessNetlogStreamJobEvent(trace_event)
+                if trace_event['args']['source_type'] == 'HTTP2_SESSION':
+                    self.ProcessNetlogHTTP2SessionEvent(trace_event)
         self.TotalDnsTime()
 
     def TotalDnsTime(self):
@@ -508,47 +878,300 @@ class Trace():
             self.netlog['ssl_sockets'][s['id']]['ssl_bytes_out'] += s['args']['params']['byte_count']
             self.netlog['ssl_bytes_out'] += s['args']['params']['byte_count']
 
+    def ProcessNetlogURLRequestEvent(self, s):
+        # The URL of each URL_REQUEST source, when it started and when its request was sent, in ms
+        if s['id'] not in self.netlog_url_requests:
+            self.netlog_url_requests[s['id']] = {'url': None, 'startTime': None, 'sendStart': None, 'sendEnd': None}
+        url_request = self.netlog_url_requests[s['id']]
+        _ts = (s['ts'] - self.start_time) / 1000
+        if s['name'] == 'URL_REQUEST_START_JOB' and s['ph'] == 'b' and 'url' in s['args'].get('params', {}):
+            url_request['url'] = s['args']['params']['url']
+            url_request['startTime'] = _ts
+        elif s['name'] == 'HTTP_TRANSACTION_SEND_REQUEST':
+            if s['ph'] == 'b':
+                url_request['sendStart'] = _ts
+            elif s['ph'] == 'e':
+                url_request['sendEnd'] = _ts
+        elif s['name'] == 'HTTP_STREAM_REQUEST_BOUND_TO_JOB':
+            _job_id = s['args'].get('params', {}).get('source_dependency', {}).get('id')
+            if _job_id is not None:
+                self.StreamJob(_job_id)['request'] = s['id']
+
+    def ProcessNetlogStreamJobEvent(self, s):
+        # The URL_REQUEST an HTTP_STREAM_JOB was bound to and the socket it took from the pool
+        _source_id = s['args'].get('params', {}).get('source_dependency', {}).get('id')
+        if _source_id is None:
+            return
+        if s['name'] == 'HTTP_STREAM_JOB_BOUND_TO_REQUEST':
+            self.StreamJob(s['id'])['request'] = _source_id
+        elif s['name'] == 'SOCKET_POOL_BOUND_TO_SOCKET':
+            job = self.StreamJob(s['id'])
+            job['socket'] = _source_id
+            job['boundTime'] = (s['ts'] - self.start_time) / 1000
+
+    def StreamJob(self, job_id):
+        if job_id not in self.netlog_stream_jobs:
+            self.netlog_stream_jobs[job_id] = {'request': None, 'socket': None, 'boundTime': None}
+        return self.netlog_stream_jobs[job_id]
+
+    def ProcessNetlogConnectionEvent(self, s):
+        # One record per socket: the TCP connect and TLS handshake spans, and the periods it was handed to a request
+        # (SOCKET_IN_USE, whose source dependency is the HTTP_STREAM_JOB that took it from the pool for the request,
+        # not the URL_REQUEST itself). Times are in ms like the activities.
+        if 'connections' not in self.netlog:
+            self.netlog['connections'] = {}
+        if s['id'] not in self.netlog['connections']:
+            self.netlog['connections'][s['id']] = {'address': None, 'connectStart': None, 'connectEnd': None,
+                                                   'sslStart': None, 'sslEnd': None, 'inUse': [], 'idle': [],
+                                                   'requests': [], 'activities': [], 'setupOnCriticalPath': False}
+        connection = self.netlog['connections'][s['id']]
+        params = s['args'].get('params', {})
+        _ts = (s['ts'] - self.start_time) / 1000
+        if s['name'] == 'TCP_CONNECT':
+            if s['ph'] == 'b':
+                connection['connectStart'] = _ts
+                if len(params.get('address_list', [])):
+                    connection['address'] = params['address_list'][0]
+            elif s['ph'] == 'e':
+                connection['connectEnd'] = _ts
+        elif s['name'] == 'SSL_CONNECT':
+            if s['ph'] == 'b':
+                connection['sslStart'] = _ts
+            elif s['ph'] == 'e':
+                connection['sslEnd'] = _ts
+        elif s['name'] == 'SOCKET_IN_USE':
+            if s['ph'] == 'b':
+                _source_id = params.get('source_dependency', {}).get('id')
+                connection['inUse'].append({'startTime': _ts, 'endTime': None, 'job': _source_id, 'url': None})
+            elif s['ph'] == 'e' and len(connection['inUse']) and connection['inUse'][-1]['endTime'] is None:
+                connection['inUse'][-1]['endTime'] = _ts
+
+    def ProcessConnections(self):
+        # Link every connection to the Networking activities of the requests it served and find the periods it sat
+        # idle between them, i.e. what keep-alive saved a new connection for. A use leads to its URL_REQUEST through
+        # the stream job the request was bound to; a use that doesn't name its job gets the last one bound to the
+        # socket before the use ended.
+        if 'connections' not in self.netlog:
+            self.netlog['connections'] = {}
+        requests = self.NetworkRequestsByURL()
+        starts = dict((net_obj[0], net_obj[1]['startTime']) for net_obj in self.networks_list)
+        socket_jobs = {}
+        for _job_id, job in sorted(self.netlog_stream_jobs.items(), key=lambda item: item[1]['boundTime'] or 0):
+            if job['socket'] is not None and job['boundTime'] is not None:
+                _times, _ids = socket_jobs.setdefault(job['socket'], ([], []))
+                _times.append(job['boundTime'])
+                _ids.append(_job_id)
+        for _socket_id in list(self.netlog['connections']):
+            connection = self.netlog['connections'][_socket_id]
+            # Sockets without a connect or a use are the SSL side of another one, or were cut off
+            if connection['connectStart'] is None and not len(connection['inUse']):
+                del self.netlog['connections'][_socket_id]
+                continue
+            _previous_end = connection['sslEnd'] if connection['sslEnd'] is not None else connection['connectEnd']
+            for use in connection['inUse']:
+                if _previous_end is not None and use['startTime'] > _previous_end:
+                    connection['idle'].append({'startTime': _previous_end, 'endTime': use['startTime']})
+                _previous_end = use['endTime']
+                _job_id = use.pop('job')
+                if _job_id is None and _socket_id in socket_jobs:
+                    _times, _ids = socket_jobs[_socket_id]
+                    _end = use['endTime'] if use['endTime'] is not None else float('inf')
+                    i = bisect.bisect_right(_times, _end) - 1
+                    if i >= 0:
+                        _job_id = _ids[i]
+                _request_id = self.netlog_stream_jobs.get(_job_id, {}).get('request')
+                use['url'] = self.netlog_url_requests.get(_request_id, {}).get('url')
+                if use['url'] is None:
+                    continue
+                connection['requests'].append(use['url'])
+                _nodeId = self.FindNetworkRequest(requests, use['url'], use['startTime'])
+                if _nodeId is not None:
+                    if len(connection['activities']):
+                        self.network_reused.add(_nodeId)
+                    connection['activities'].append(_nodeId)
+            # The connect and TLS setup belong to the first request only if it was sent before the connect finished,
+            # one sent later found the socket already open (a preconnect) and its phases stay -1
+            if connection['connectStart'] is not None and connection['connectEnd'] is not None and \
+                    len(connection['activities']) and connection['inUse'][0]['url'] is not None and \
+                    starts[connection['activities'][0]] < connection['connectEnd']:
+                self.network_setup.setdefault(connection['activities'][0], connection)
+
+    def FlagCriticalConnections(self):
+        # A connection's setup is on the critical path when the request it was opened for is
+        critical = set(self.critical_path)
+        for _nodeId, connection in self.network_setup.items():
+            connection['setupOnCriticalPath'] = _nodeId in critical
+
+    def ProcessNetworkPhases(self):
+        # Split every request into queueing, DNS, connect, TLS, request, TTFB and download. The connection a request
+        # opened gives its connect and TLS spans (reused connections have none), its URL_REQUEST the request send, and
+        # the DNS transactions are indexed by host and start time so each request's lookup is a binary search. The
+        # spans are kept to sum them along the critical path; absent phases are -1 in the output.
+        dns = {}
+        for _dns in sorted(self.netlog['dns'].values(), key=lambda d: d.get('dnsStart', 0)):
+            if 'hostname' in _dns and 'dnsStart' in _dns and 'dnsEnd' in _dns:
+                _starts, _ends = dns.setdefault(_dns['hostname'], ([], []))
+                _starts.append(_dns['dnsStart'])
+                _ends.append(_dns['dnsEnd'])
+        setup = self.network_setup
+        requests = self.NetworkRequestsByURL()
+        sends = {}
+        for url_request in self.netlog_url_requests.values():
+            if url_request['sendStart'] is not None and url_request['sendEnd'] is not None:
+                _nodeId = self.FindNetworkRequest(requests, url_request['url'], url_request['startTime'])
+                if _nodeId is not None:
+                    sends.setdefault(_nodeId, url_request)
+
+        for _nodeId, _nodeData in self.networks_list:
+            _startTime = _nodeData['startTime']
+            spans = {}
+            connection = setup.get(_nodeId)
+            if connection is not None:
+                if connection['connectEnd'] is not None:
+                    spans['connect'] = (connection['connectStart'], connection['connectEnd'])
+                if connection['sslStart'] is not None and connection['sslEnd'] is not None:
+                    spans['tls'] = (connection['sslStart'], connection['sslEnd'])
+            if _nodeId in sends:
+                spans['request'] = (sends[_nodeId]['sendStart'], sends[_nodeId]['sendEnd'])
+            # The last lookup of the host started before its connection (or response) is its own if it was still
+            # running when the request started, requests on a reused connection didn't wait for one
+            _host = urlparse(_nodeData['url']).hostname
+            _bound = connection['connectStart'] if connection is not None else _nodeData.get('responseReceivedTime')
+            if _host in dns and _bound is not None and (connection is not None or _nodeId not in self.network_reused):
+                _starts, _ends = dns[_host]
+                i = bisect.bisect_right(_starts, _bound) - 1
+                if i >= 0 and _ends[i] > _startTime:
+                    spans['dns'] = (_starts[i], _ends[i])
+            _first = [span[0] for span in spans.values()]
+            if len(_first):
+                spans['queueing'] = (_startTime, min(_first))
+            if 'responseReceivedTime' in _nodeData:
+                _sent = [span[1] for span in spans.values() if span[1] <= _nodeData['responseReceivedTime']]
+                spans['ttfb'] = (max(_sent + [_startTime]), _nodeData['responseReceivedTime'])
+                spans['download'] = (_nodeData['responseReceivedTime'], _nodeData['endTime'])
+            # Setup done before the request was sent (a preconnect) isn't part of it
+            spans = {phase: (max(start, _startTime), max(end, _startTime)) for phase, (start, end) in spans.items()}
+            self.network_phase_spans[_nodeId] = spans
+            self.network_phases[_nodeId] = {phase: round(spans[phase][1] - spans[phase][0], 3) if phase in spans
+                                            else -1 for phase in NETWORK_PHASES}
+
+    def ProcessBandwidth(self):
+        # Byte arrival from every ResourceReceivedData event: a cumulative [[time, bytes], ...] series per request and
+        # the bytes that arrived per BANDWIDTH_BUCKET_MS bucket page-wide, next to the number of requests in flight.
+        # Buckets with requests in flight and nothing arriving are time the load was waiting on latency.
+        if not len(self.received_data):
+            return
+        times = np.array([data[1] for data in self.received_data], dtype=np.float64)
+        lengths = np.array([data[2] for data in self.received_data], dtype=np.int64)
+        times = np.maximum(times, 0)
+        buckets = (times // BANDWIDTH_BUCKET_MS).astype(np.int64)
+        _ends = np.array([obj[1]['endTime'] for obj in self.networks_list], dtype=np.float64)
+        count = int(max(buckets.max(), (_ends.max() // BANDWIDTH_BUCKET_MS) if len(_ends) else 0)) + 1
+        received = np.bincount(buckets, lengths, minlength=count).astype(np.int64)
+        in_flight = np.zeros(count + 1, dtype=np.int64)
+        if len(self.networks_list):
+            _starts = np.array([obj[1]['startTime'] for obj in self.networks_list], dtype=np.float64)
+            np.add.at(in_flight, (np.maximum(_starts, 0) // BANDWIDTH_BUCKET_MS).astype(np.int64), 1)
+            np.add.at(in_flight, (np.maximum(_ends, 0) // BANDWIDTH_BUCKET_MS).astype(np.int64) + 1, -1)
+        in_flight = np.cumsum(in_flight)[:count]
+        self.bandwidth = {'bucketMs': BANDWIDTH_BUCKET_MS, 'bytes': received.tolist(), 'inFlight': in_flight.tolist(),
+                          'peakKbps': round(float(received.max()) * 8 / BANDWIDTH_BUCKET_MS, 3),
+                          'latencyBoundTime': int(np.count_nonzero((in_flight > 0) & (received == 0))) *
+                                              BANDWIDTH_BUCKET_MS}
+
+        # Per request series: sort by request then time, and restart the running total at each request
+        requests = dict((obj[1]['id'], i) for i, obj in enumerate(self.networks_list))
+        request = np.array([requests.get(data[0], -1) for data in self.received_data], dtype=np.int64)
+        order = np.lexsort((times, request))
+        order = order[request[order] >= 0]
+        if not len(order):
+            return
+        request = request[order]
+        cumulative = np.cumsum(lengths[order])
+        first = np.flatnonzero(np.concatenate(([True], request[1:] != request[:-1])))
+        cumulative -= np.repeat(cumulative[first] - lengths[order][first], np.diff(np.append(first, len(order))))
+        for start, end in zip(first, np.append(first[1:], len(order))):
+            self.network_bytes[self.networks_list[request[start]][0]] = \
+                [[round(float(t), 3), int(b)] for t, b in zip(times[order[start:end]], cumulative[start:end])]
+
+    def NetworkRequestsByURL(self):
+        # {url: ([startTime, ...], [Networking_N, ...])}, networks_list is sorted by start so each URL's are as well
+        requests = {}
+        for net_obj in self.networks_list:
+            _starts, _ids = requests.setdefault(urldefrag(net_obj[1]['url'])[0], ([], []))
+            _starts.append(net_obj[1]['startTime'])
+            _ids.append(net_obj[0])
+        return requests
+
+    def FindNetworkRequest(self, requests, url, timestamp):
+        # The last request for a URL sent at or before timestamp, or its first one if they were all sent later
+        if url is None or urldefrag(url)[0] not in requests:
+            return None
+        _starts, _ids = requests[urldefrag(url)[0]]
+        return _ids[max(bisect.bisect_right(_starts, timestamp) - 1, 0)]
+
     def ProcessNetlogHTTP2SessionEvent(self, s):
-        if 'params' in s['args'] and 'stream_id' in s['args']['params']:
-            if 'http2' not in self.netlog:
-                self.netlog['http2'] = {'bytes_in': 0, 'bytes_out': 0}
-            if s['id'] not in self.netlog['http2']:
-                self.netlog['http2'][s['id']] = {'bytes_in': 0, 'bytes_out': 0, 'streams': {}}
-            stream = '{0:d}'.format(s['args']['params']['stream_id'])
-            if stream not in self.netlog['http2'][s['id']]['streams']:
-                self.netlog['http2'][s['id']]['streams'][stream] = {'start': s['tts'], 'end': s['tts'], 'bytes_in': 0,
-                                                                    'bytes_out': 0}
-            if s['tts'] > self.netlog['http2'][s['id']]['streams'][stream]['end']:
-                self.netlog['http2'][s['id']]['streams'][stream]['end'] = s['tts']
-
-        if s['name'] == 'HTTP2_SESSION_SEND_HEADERS' and 'params' in s['args']:
-            if 'request' not in self.netlog['http2'][s['id']]['streams'][stream]:
-                self.netlog['http2'][s['id']]['streams'][stream]['request'] = {}
-            if 'headers' in s['args']['params']:
-                self.netlog['http2'][s['id']]['streams'][stream]['request']['headers'] = s['args']['params']['headers']
-            if 'parent_stream_id' in s['args']['params']:
-                self.netlog['http2'][s['id']]['streams'][stream]['request']['parent_stream_id'] = s['args']['params'][
-                    'parent_stream_id']
-            if 'exclusive' in s['args']['params']:
-                self.netlog['http2'][s['id']]['streams'][stream]['request']['exclusive'] = s['args']['params'][
-                    'exclusive']
-            if 'priority' in s['args']['params']:
-                self.netlog['http2'][s['id']]['streams'][stream]['request']['priority'] = s['args']['params'][
-                    'priority']
-
-        if s['name'] == 'HTTP2_SESSION_RECV_HEADERS' and 'params' in s['args']:
-            if 'first_byte' not in self.netlog['http2'][s['id']]['streams'][stream]:
-                self.netlog['http2'][s['id']]['streams'][stream]['first_byte'] = s['tts']
-            if 'response' not in self.netlog['http2'][s['id']]['streams'][stream]:
-                self.netlog['http2'][s['id']]['streams'][stream]['response'] = {}
-            if 'headers' in s['args']['params']:
-                self.netlog['http2'][s['id']]['response']['streams'][stream]['headers'] = s['args']['params']['headers']
-
-        if s['name'] == 'HTTP2_SESSION_RECV_DATA' and 'params' in s['args'] and 'size' in s['args']['params']:
-            if 'first_byte' not in self.netlog['http2'][s['id']]['streams'][stream]:
-                self.netlog['http2'][s['id']]['streams'][stream]['first_byte'] = s['tts']
-            self.netlog['http2'][s['id']]['streams'][stream]['bytes_in'] += s['args']['params']['size']
-            self.netlog['http2'][s['id']]['bytes_in'] += s['args']['params']['size']
+        # Per session index of its streams by stream id: when each was opened and closed, its first byte, bytes in and
+        # out, and the priority and parent stream it was sent with. Times are in ms like the activities.
+        if 'params' not in s['args'] or 'stream_id' not in s['args']['params']:
+            return
+        params = s['args']['params']
+        if 'http2' not in self.netlog:
+            self.netlog['http2'] = {'bytes_in': 0, 'bytes_out': 0, 'sessions': {}}
+        if s['id'] not in self.netlog['http2']['sessions']:
+            self.netlog['http2']['sessions'][s['id']] = {'bytes_in': 0, 'bytes_out': 0, 'streams': {}}
+        session = self.netlog['http2']['sessions'][s['id']]
+        stream_id = '{0:d}'.format(params['stream_id'])
+        _ts = (s['ts'] - self.start_time) / 1000
+        if stream_id not in session['streams']:
+            session['streams'][stream_id] = {'startTime': _ts, 'endTime': _ts, 'firstByte': None, 'bytes_in': 0,
+                                             'bytes_out': 0, 'priority': None, 'parentStreamId': None,
+                                             'exclusive': None, 'url': None, 'activityId': None}
+        stream = session['streams'][stream_id]
+        stream['startTime'] = min(stream['startTime'], _ts)
+        stream['endTime'] = max(stream['endTime'], _ts)
+
+        if s['name'] == 'HTTP2_SESSION_SEND_HEADERS':
+            if 'headers' in params:
+                stream['url'] = http2_request_url(params['headers'])
+            # Chrome logs an HTTP/2 weight, older versions a SPDY priority
+            if 'weight' in params:
+                stream['priority'] = params['weight']
+            elif 'priority' in params:
+                stream['priority'] = params['priority']
+            if 'parent_stream_id' in params:
+                stream['parentStreamId'] = params['parent_stream_id']
+            if 'exclusive' in params:
+                stream['exclusive'] = params['exclusive']
+        elif s['name'] == 'HTTP2_SESSION_RECV_HEADERS':
+            if stream['firstByte'] is None:
+                stream['firstByte'] = _ts
+        elif s['name'] == 'HTTP2_SESSION_RECV_DATA' and 'size' in params:
+            if stream['firstByte'] is None:
+                stream['firstByte'] = _ts
+            stream['bytes_in'] += params['size']
+            session['bytes_in'] += params['size']
+            self.netlog['http2']['bytes_in'] += params['size']
+        elif s['name'] == 'HTTP2_SESSION_SEND_DATA' and 'size' in params:
+            stream['bytes_out'] += params['size']
+            session['bytes_out'] += params['size']
+            self.netlog['http2']['bytes_out'] += params['size']
+
+    def JoinHTTP2Streams(self):
+        # Join each HTTP/2 stream to the Networking activity of its URL
+        if 'http2' not in self.netlog:
+            self.netlog['http2'] = {'bytes_in': 0, 'bytes_out': 0, 'sessions': {}}
+            return
+        requests = self.NetworkRequestsByURL()
+        for _session_id, session in self.netlog['http2']['sessions'].items():
+            for stream_id, stream in session['streams'].items():
+                _nodeId = self.FindNetworkRequest(requests, stream['url'], stream['startTime'])
+                if _nodeId is None:
+                    continue
+                stream['activityId'] = _nodeId
+                self.network_http2[_nodeId] = {'session': _session_id, 'streamId': int(stream_id),
+                                               'priority': stream['priority'],
+                                               'parentStreamId': stream['parentStreamId']}
 
     def ProcessNetworkEvents(self, network_trace_events):
         for net_trace in network_trace_events:
@@ -558,6 +1181,8 @@ class Trace():
             if net_trace['name'] == 'ResourceSendRequest':
                 _url = net_trace['args']['data']['url']
                 _startTime = net_trace['ts']
+                if 'url' in self.networks[_request_id]:
+                    self.SplitRedirect(_request_id, (_startTime - self.start_time) / 1000)
                 self.networks[_request_id]['url'] = _url
                 self.networks[_request_id]['startTime'] = (_startTime - self.start_time) / 1000
 
@@ -578,186 +1203,175 @@ class Trace():
 
             elif net_trace['name'] == 'ResourceReceivedData':
                 _encodedDataLength = net_trace['args']['data']['encodedDataLength']
-                if _encodedDataLength != 0 or 'transferSize' not in self.networks[_request_id]:
-                    self.networks[_request_id]['transferSize'] = _encodedDataLength
+                self.networks[_request_id]['transferSize'] = self.networks[_request_id].get('transferSize', 0) + \
+                                                             _encodedDataLength
+                self.received_data.append((_request_id, (net_trace['ts'] - self.start_time) / 1000,
+                                           _encodedDataLength))
 
             elif net_trace['name'] == 'ResourceFinish':
                 _endTime = net_trace['ts']
                 _didFail = net_trace['args']['data']['didFail']
                 if not _didFail:
                     self.networks[_request_id]['endTime'] = (_endTime - self.start_time) / 1000
+                    # Newer Chrome versions only report the bytes once the request finished
+                    if not self.networks[_request_id].get('transferSize') and \
+                                    net_trace['args']['data'].get('encodedDataLength'):
+                        self.networks[_request_id]['transferSize'] = net_trace['args']['data']['encodedDataLength']
                 else:
                     self.networks.pop(_request_id, None)
             else:
                 raise Exception('Unknown network name in net_trace')
 
-    def is_balanced(self, a_list):
-        my_list = copy.deepcopy(a_list)
-        t_stack = []
-        for i in range(len(my_list)):
-            if my_list[i]['ph'] == 'B':
-                t_stack.append('B')
-            elif my_list[i]['ph'] == 'E':
-                t_stack.pop()
-        if len(t_stack) == 0:
-            return True
-        return False
-
-    def merge_events(self, aList):
-        if len(aList) > 2:
-            return [[aList[0], aList[-1]], [aList[1:-1]]]
-        else:
-            return [[aList[0], aList[-1]]]
+    def SplitRedirect(self, _request_id, _redirectTime):
+        # Chrome keeps the requestId across a redirect: what was recorded for it so far is a hop of the chain, which
+        # ended when the next request was sent. Hops are kept as <requestId>:redirected.<n>, each linked to the
+        # previous one through redirectedFrom.
+        _hops = self.redirect_hops.setdefault(_request_id, [])
+        _hop_id = _request_id + ':redirected.' + str(len(_hops))
+        _hop = self.networks[_request_id]
+        _hop['endTime'] = _redirectTime
+        _hop.setdefault('responseReceivedTime', _redirectTime)
+        _hop.setdefault('statusCode', None)
+        _hop.setdefault('mimeType', '')
+        _hop['redirect'] = True
+        self.networks[_hop_id] = _hop
+        self.networks[_request_id] = {'redirectedFrom': _hop_id}
+        _hops.append(_hop_id)
+        # The network events are time sorted, so every byte received under the requestId so far was the hop's
+        self.received_data = [(_hop_id,) + data[1:] if data[0] == _request_id else data
+                              for data in self.received_data]
+
+    def DropIncompleteRequests(self):
+        # In a salvaged trace the events of a request can be split by the truncation, only keep the ones whose
+        # response made it into the file
+        for _request_id in list(self.networks):
+            if 'responseReceivedTime' not in self.networks[_request_id] or 'url' not in self.networks[_request_id]:
+                self.networks.pop(_request_id)
+
+    def BuildSpans(self, trace_events):
+        # Pair the B/E events of a stage with a stack per (pid, tid, name) in one pass over the time sorted events.
+        # Nested events of the same name make one span from the outermost B to its E. Returns the spans in the order
+        # they complete, as [begin, end] or [event] for X events, with their times converted to ms.
+        spans = []
+        stacks = {}
+        for trace_event in trace_events:
+            trace_event['ts'] = (trace_event['ts'] - self.start_time) / 1000
+            if trace_event['ph'] == 'X':  # The ts parameter indicate the time of the start of the 'complete (X)' event.
+                if 'dur' in trace_event:
+                    trace_event['dur'] /= 1000
+                spans.append([trace_event])
+            elif trace_event['ph'] == 'B' or trace_event['ph'] == 'E':
+                stack = stacks.setdefault((trace_event['pid'], trace_event['tid'], trace_event['name']), [])
+                if trace_event['ph'] == 'B':
+                    stack.append(trace_event)
+                elif not len(stack):
+                    logging.warning('E detected without any B in: ' + trace_event['name'])
+                else:
+                    begin = stack.pop()
+                    if not len(stack):
+                        spans.append([begin, trace_event])
+        return spans
+
+    def SplitMainThreadSpans(self, spans):
+        # Keep the main thread spans and sum up the others per thread and name: {thread: {name: {count, duration}}}
+        main_spans = []
+        off_thread = {}
+        for span in spans:
+            thread = '{0}:{1}'.format(span[0]['pid'], span[0]['tid'])
+            if self.cpu['main_thread'] is None or thread == self.cpu['main_thread']:
+                main_spans.append(span)
+                continue
+            if span[0]['ph'] == 'X':
+                duration = span[0].get('dur', 0)
+            else:
+                duration = span[1]['ts'] - span[0]['ts']
+            summary = off_thread.setdefault(thread, {}).setdefault(span[0]['name'], {'count': 0, 'duration': 0})
+            summary['count'] += 1
+            summary['duration'] += duration
+        for names in off_thread.values():
+            for summary in names.values():
+                summary['duration'] = round(summary['duration'], 3)
+        return main_spans, off_thread
 
     def ProcessLoadingEvents(self, loading_trace_events):
-        load_list = []
-        tmp_stack = []
-        for loading_event in loading_trace_events:
-            loading_event['ts'] = (loading_event['ts'] - self.start_time) / 1000
-            if loading_event['ph'] == 'B' or loading_event['ph'] == 'E':
-                if loading_event['ph'] == 'B':
-                    tmp_stack.append(loading_event)
-                elif loading_event['ph'] == 'E':
-                    if not len(tmp_stack) == 0:
-                        tmp_stack.append(loading_event)
-                    else:
-                        logging.warning('E detected without any B')
-                        continue
-                if self.is_balanced(tmp_stack):
-                    load_list.append(self.merge_events(tmp_stack))
-                    tmp_stack = []
-            ###
-            # ParseAuthorStyleSheet
-            ###
-            elif loading_event[
-                'ph'] == 'X':  # The ts parameter indicate the time of the start of the 'complete (X)' event.
-                loading_event['dur'] /= 1000
-                load_list.append([[loading_event]])
-
+        # ParseHTML (B/E) and ParseAuthorStyleSheet (X)
+        load_list = self.BuildSpans(loading_trace_events)
         for i in range(len(load_list)):
             self.loading['Loading_' + str(i)] = {}
             self.loading['Loading_' + str(i)]['fromScript'] = None
             self.loading['Loading_' + str(i)]['styleSheetUrl'] = None
             self.loading['Loading_' + str(i)]['url'] = None
 
-            _name = load_list[i][0][0]['name']
+            _name = load_list[i][0]['name']
             self.loading['Loading_' + str(i)]['name'] = _name
-            _startTime = load_list[i][0][0]['ts']
+            _startTime = load_list[i][0]['ts']
             self.loading['Loading_' + str(i)]['startTime'] = _startTime
 
-            if load_list[i][0][0]['ph'] == 'B':
-                _endTime = load_list[i][0][1]['ts']
+            if load_list[i][0]['ph'] == 'B':
+                _endTime = load_list[i][1]['ts']
                 self.loading['Loading_' + str(i)]['endTime'] = _endTime
-                _pageURL = load_list[i][0][0]['args']['beginData']['url']
+                _pageURL = load_list[i][0]['args']['beginData']['url']
                 self.loading['Loading_' + str(i)]['url'] = _pageURL
-                if 'stackTrace' in load_list[i][0][0]['args']['beginData']:
-                    _scriptUrL = load_list[i][0][0]['args']['beginData']['stackTrace'][0]['url']
+                if 'stackTrace' in load_list[i][0]['args']['beginData']:
+                    _scriptUrL = load_list[i][0]['args']['beginData']['stackTrace'][0]['url']
                     self.loading['Loading_' + str(i)]['fromScript'] = _scriptUrL
-            elif load_list[i][0][0]['ph'] == 'X':
-                _duration = load_list[i][0][0]['dur']
+            elif load_list[i][0]['ph'] == 'X':
+                _duration = load_list[i][0]['dur']
                 _endTime = _startTime + _duration
                 self.loading['Loading_' + str(i)]['endTime'] = _endTime
-                if 'data' in load_list[i][0][0]['args']:
-                    _styleSheetUrl = load_list[i][0][0]['args']['data']['styleSheetUrl']
+                if 'data' in load_list[i][0]['args']:
+                    _styleSheetUrl = load_list[i][0]['args']['data']['styleSheetUrl']
                     self.loading['Loading_' + str(i)]['styleSheetUrl'] = _styleSheetUrl
         self.loading = collections.OrderedDict(sorted(self.loading.items(), key=lambda t: int(t[0].split('_')[1])))
 
     def ProcessPaintingEvents(self, painting_trace_events):
-        paint_list = []
-        tmp_stack = []
-        for paint_event in painting_trace_events:
-            paint_event['ts'] = (paint_event['ts'] - self.start_time) / 1000
-            if paint_event['ph'] == 'B' or paint_event['ph'] == 'E':
-                if paint_event['ph'] == 'B':
-                    tmp_stack.append(paint_event)
-                elif paint_event['ph'] == 'E':
-                    if not len(tmp_stack) == 0:
-                        tmp_stack.append(paint_event)
-                    else:
-                        logging.warning('E detected without any B')
-                        continue
-                if self.is_balanced(tmp_stack):
-                    paint_list.append(self.merge_events(tmp_stack))
-                    tmp_stack = []
-            ###
-            # Paint
-            ###
-            elif paint_event[
-                'ph'] == 'X':  # The ts parameter indicate the time of the start of the 'complete (X)' event.
-                if 'dur' in paint_event:
-                    paint_event['dur'] /= 1000
-                else:
-                    paint_event['dur'] = 0
-                paint_list.append([[paint_event]])
+        # Paint, CompositeLayers, ...
+        paint_list, self.off_thread_painting = self.SplitMainThreadSpans(self.BuildSpans(painting_trace_events))
         for i in range(len(paint_list)):
             self.painting['Painting_' + str(i)] = {}
-            _startTime = paint_list[i][0][0]['ts']
+            self.painting['Painting_' + str(i)]['thread'] = '{0}:{1}'.format(paint_list[i][0]['pid'],
+                                                                             paint_list[i][0]['tid'])
+            _startTime = paint_list[i][0]['ts']
             self.painting['Painting_' + str(i)]['startTime'] = _startTime
-            _name = paint_list[i][0][0]['name']
+            _name = paint_list[i][0]['name']
             self.painting['Painting_' + str(i)]['name'] = _name
-            if paint_list[i][0][0]['ph'] == 'B':
-                _endTime = paint_list[i][0][1]['ts']
+            if paint_list[i][0]['ph'] == 'B':
+                _endTime = paint_list[i][1]['ts']
                 self.painting['Painting_' + str(i)]['endTime'] = _endTime
-                if 'args' in paint_list[i][0][0]:
-                    if 'layerTreeId' in paint_list[i][0][0]['args']:
-                        _layerTreeId = paint_list[i][0][0]['args']['layerTreeId']
+                if 'args' in paint_list[i][0]:
+                    if 'layerTreeId' in paint_list[i][0]['args']:
+                        _layerTreeId = paint_list[i][0]['args']['layerTreeId']
                     else:
                         _layerTreeId = None
                     self.painting['Painting_' + str(i)]['layerTreeId'] = _layerTreeId
-            elif paint_list[i][0][0]['ph'] == 'X':
-                _duration = paint_list[i][0][0]['dur']
+            elif paint_list[i][0]['ph'] == 'X':
+                _duration = paint_list[i][0].get('dur', 0)
                 _endTime = _startTime + _duration
                 self.painting['Painting_' + str(i)]['endTime'] = _endTime
 
         self.painting = collections.OrderedDict(sorted(self.painting.items(), key=lambda t: int(t[0].split('_')[1])))
 
     def ProcessRenderingEvents(self, rendering_trace_events):
-        render_list = []
-        tmp_stack = []
-        # main_pid = self.cpu['main_thread'].split(':')[0]
-        # main_tid = self.cpu['main_thread'].split(':')[1]
-
-        for render_event in rendering_trace_events:
-            render_event['ts'] = (render_event['ts'] - self.start_time) / 1000
-            ###
-            # Layout, RecalculateStyle, HitTest
-            ###
-            if render_event['ph'] == 'B' or render_event['ph'] == 'E':
-                if render_event['ph'] == 'B':
-                    tmp_stack.append(render_event)
-                elif render_event['ph'] == 'E':
-                    if not len(tmp_stack) == 0:
-                        tmp_stack.append(render_event)
-                    else:
-                        logging.warning('E detected without any B in: ' + render_event['name'])
-                        continue
-                if self.is_balanced(tmp_stack):
-                    render_list.append(self.merge_events(tmp_stack))
-                    tmp_stack = []
-                    ###
-                    # UpdateLayerTree
-                    ###
-            elif render_event[
-                'ph'] == 'X':  # The ts parameter indicate the time of the start of the 'complete (X)' event.
-                if 'dur' in render_event:
-                    render_event['dur'] /= 1000
-                    render_list.append([[render_event]])
-
+        # Layout, RecalculateStyle, HitTest (B/E) and UpdateLayerTree (X), X events without a duration are dropped
+        render_list, self.off_thread_rendering = self.SplitMainThreadSpans(
+            [span for span in self.BuildSpans(rendering_trace_events) if span[0]['ph'] != 'X' or 'dur' in span[0]])
         for i in range(len(render_list)):
             self.rendering['Rendering_' + str(i)] = {}
-            _startTime = render_list[i][0][0]['ts']
+            self.rendering['Rendering_' + str(i)]['thread'] = '{0}:{1}'.format(render_list[i][0]['pid'],
+                                                                               render_list[i][0]['tid'])
+            _startTime = render_list[i][0]['ts']
             self.rendering['Rendering_' + str(i)]['startTime'] = _startTime
-            _name = render_list[i][0][0]['name']
+            _name = render_list[i][0]['name']
             self.rendering['Rendering_' + str(i)]['name'] = _name
-            if render_list[i][0][0]['ph'] == 'B':
-                _endTime = render_list[i][0][1]['ts']
+            if render_list[i][0]['ph'] == 'B':
+                _endTime = render_list[i][1]['ts']
                 self.rendering['Rendering_' + str(i)]['endTime'] = _endTime
                 ###
                 # {"pid":20396,"tid":775,"ts":1390025575932,"ph":"B","cat":"devtools.timeline","name":"Layout",
                 # "args":{"beginData":{"dirtyObjects":25,"frame":"0x2b8722801e08","partialLayout":false,"totalObjects":241}},"tts":2462518},
                 ###
-            elif render_list[i][0][0]['ph'] == 'X':
-                _duration = render_list[i][0][0]['dur']
+            elif render_list[i][0]['ph'] == 'X':
+                _duration = render_list[i][0]['dur']
                 _endTime = _startTime + _duration
                 self.rendering['Rendering_' + str(i)]['endTime'] = _endTime
 
@@ -769,7 +1383,7 @@ class Trace():
         if self.cpu['main_thread'] is None and trace_event[
             'name'] == 'ResourceSendRequest' and 'args' in trace_event and \
                         'data' in trace_event['args'] and 'url' in trace_event['args']['data']:
-            if trace_event['args']['data']['url'][:21] == 'http://127.0.0.1:8888':
+            if trace_event['args']['data']['url'][:21] == HARNESS_URL:
                 self.ignore_threads[thread] = True
             else:
                 if thread not in self.threads:
@@ -785,11 +1399,15 @@ class Trace():
                         trace_event['name'] != 'Program':
             self.threads[thread] = {}
 
-        # Build timeline events on a stack. 'B' begins an event, 'E' ends an event
+        # Build timeline events on a stack. 'B' begins an event, 'E' ends an event. Complete events (with a 'dur') stay
+        # on the stack until an event starts at or after their end so the events inside them nest the same way.
         if (thread in self.threads and ('dur' in trace_event or trace_event['ph'] == 'B' or trace_event['ph'] == 'E')):
             trace_event['thread'] = self.threads[thread]
             if thread not in self.thread_stack:
                 self.thread_stack[thread] = []
+            stack = self.thread_stack[thread]
+            while len(stack) > 0 and stack[-1].e is not None and stack[-1].e <= trace_event['ts']:
+                stack.pop()
             if trace_event['name'] not in self.event_names:
                 self.event_names[trace_event['name']] = len(self.event_names)
                 self.event_name_lookup[self.event_names[trace_event['name']]] = trace_event['name']
@@ -797,40 +1415,46 @@ class Trace():
                 self.threads[thread][trace_event['name']] = self.event_names[trace_event['name']]
             e = None
             if trace_event['ph'] == 'E':
-                if len(self.thread_stack[thread]) > 0:
-                    e = self.thread_stack[thread].pop()
-                    if e['n'] == self.event_names[trace_event['name']]:
-                        e['e'] = trace_event['ts']
+                # A complete event that runs past the end of its 'B' parent can't be a parent anymore
+                while len(stack) > 0 and stack[-1].e is not None:
+                    stack.pop()
+                if len(stack) > 0:
+                    e = stack.pop()
+                    if e.n == self.event_names[trace_event['name']]:
+                        e.e = trace_event['ts']
             else:
-                e = {'t': thread, 'n': self.event_names[trace_event['name']], 's': trace_event['ts']}
+                e = TimelineEvent(thread, self.event_names[trace_event['name']], trace_event['ts'])
                 if (trace_event['name'] == 'EvaluateScript' or trace_event['name'] == 'v8.compile' or trace_event[
                     'name'] == 'v8.parseOnBackground') \
                         and 'args' in trace_event and 'data' in trace_event['args'] and 'url' in trace_event['args'][
                     'data'] and \
                         trace_event['args']['data']['url'].startswith('http'):
-                    e['js'] = trace_event['args']['data']['url']
+                    e.js = trace_event['args']['data']['url']
                 if trace_event['name'] == 'FunctionCall' and 'args' in trace_event and 'data' in trace_event['args'] and \
                                 'scriptName' in trace_event['args']['data'] and trace_event['args']['data'][
                     'scriptName'].startswith('http'):
-                    e['js'] = trace_event['args']['data']['scriptName']
+                    e.js = trace_event['args']['data']['scriptName']
                 if trace_event['ph'] == 'B':
-                    self.thread_stack[thread].append(e)
+                    stack.append(e)
                     e = None
                 elif 'dur' in trace_event:
-                    e['e'] = e['s'] + trace_event['dur']
-
-            if e is not None and 'e' in e and e['s'] >= self.start_time and e['e'] >= e['s']:
-                if self.end_time is None or e['e'] > self.end_time:
-                    self.end_time = e['e']
-                # attach it to a parent event if there is one
-                if len(self.thread_stack[thread]) > 0:
-                    parent = self.thread_stack[thread].pop()
-                    if 'c' not in parent:
-                        parent['c'] = []
-                    parent['c'].append(e)
-                    self.thread_stack[thread].append(parent)
+                    e.e = e.s + trace_event['dur']
+
+            if e is not None and e.e is not None and e.s >= self.start_time and e.e >= e.s:
+                if self.end_time is None or e.e > self.end_time:
+                    self.end_time = e.e
+                # attach it to a parent event if there is one, a complete event that ends first can't hold it
+                while len(stack) > 0 and stack[-1].e is not None and stack[-1].e < e.e:
+                    stack.pop()
+                if len(stack) > 0:
+                    parent = stack[-1]
+                    if parent.c is None:
+                        parent.c = []
+                    parent.c.append(e)
                 else:
                     self.timeline_events.append(e)
+                if trace_event['ph'] != 'E':
+                    stack.append(e)
 
     def ProcessTimelineEvents(self):
         if len(self.timeline_events) and self.end_time > self.start_time:
@@ -843,37 +1467,79 @@ class Trace():
                 exp += 1
                 slice_count = int(math.ceil(float(self.end_time - self.start_time) / float(pow(10, exp))))
             self.cpu['total_usecs'] = self.end_time - self.start_time
-            self.cpu['slice_usecs'] = int(pow(10, last_exp))
+            self.cpu['slice_usecs'] = self.slice_usecs or int(pow(10, last_exp))
             slice_count = int(math.ceil(float(self.end_time - self.start_time) / float(self.cpu['slice_usecs'])))
 
-            # Create the empty time slices for all of the threads
-            self.cpu['slices'] = {}
+            # Create the empty time slices for all of the threads: one matrix per thread with a row per event name.
+            # Row 0 is the thread total, the others follow the order the thread first saw the names in.
             for thread in self.threads.keys():
-                self.cpu['slices'][thread] = {'total': [0.0] * slice_count}
+                rows = {'total': 0}
                 for name in self.threads[thread].keys():
-                    self.cpu['slices'][thread][name] = [0.0] * slice_count
-
-            # Go through all of the timeline events recursively and account for the time they consumed
-            for timeline_event in self.timeline_events:
-                self.ProcessTimelineEvent(timeline_event, None)
-
-            # Go through all of the fractional times and convert the float fractional times to integer usecs
-            for thread in self.cpu['slices'].keys():
-                del self.cpu['slices'][thread]['total']
-                for name in self.cpu['slices'][thread].keys():
-                    for slice in range(len(self.cpu['slices'][thread][name])):
-                        self.cpu['slices'][thread][name][slice] = \
-                            int(self.cpu['slices'][thread][name][slice] * self.cpu['slice_usecs'])
+                    if name not in rows:
+                        rows[name] = len(rows)
+                self.slice_rows[thread] = rows
+                self.slice_matrix[thread] = np.zeros((len(rows), slice_count))
+
+            # Go through all of the timeline events depth first and account for the time they consumed. The walk keeps
+            # its own stack so deeply nested call stacks can't hit the recursion limit, and visits the events in the
+            # same order a recursive walk would.
+            # The innermost enclosing script event is carried along to work out script self times.
+            stack = [(timeline_event, None, None) for timeline_event in reversed(self.timeline_events)]
+            while stack:
+                timeline_event, parent, script_parent = stack.pop()
+                name = self.ProcessTimelineEvent(timeline_event, parent)
+                if name is None:
+                    continue
+                if timeline_event.js is not None:
+                    self.AddScriptSelfTime(timeline_event, script_parent)
+                    script_parent = timeline_event
+                if timeline_event.t == self.cpu['main_thread']:
+                    self.AddSelfSegments(timeline_event, name)
+                if timeline_event.c is not None:
+                    stack.extend((child, name, script_parent) for child in reversed(timeline_event.c))
+            self.ProcessScriptExecution()
+
+            # Convert the float fractional times to integer usecs
+            self.cpu['slices'] = {}
+            usecs = {}
+            for thread, rows in self.slice_rows.items():
+                usecs[thread] = (self.slice_matrix[thread] * self.cpu['slice_usecs']).astype(np.int64)
+                self.cpu['slices'][thread] = {name: usecs[thread][row].tolist() for name, row in rows.items()
+                                              if name != 'total'}
+            self.cpu['pyramid'] = self.ProcessCPUPyramid(usecs)
+
+    def ProcessCPUPyramid(self, usecs):
+        # Sum the finest slices into each coarser level once so consumers can zoom without recomputing anything. Only
+        # the runs of non-zero slices are kept, most of a thread's slices are idle.
+        slice_usecs = self.cpu['slice_usecs']
+        pyramid = []
+        for level_usecs in sorted(self.pyramid_levels):
+            if level_usecs < slice_usecs or level_usecs % slice_usecs:
+                logging.debug('Skipping CPU pyramid level %sus, slices are %sus', level_usecs, slice_usecs)
+                continue
+            factor = level_usecs // slice_usecs
+            level = {'slice_usecs': level_usecs, 'slice_count': 0, 'slices': {}}
+            for thread, rows in self.slice_rows.items():
+                matrix = usecs[thread]
+                padding = -matrix.shape[1] % factor
+                if padding:
+                    matrix = np.pad(matrix, ((0, 0), (0, padding)))
+                matrix = matrix.reshape(matrix.shape[0], -1, factor).sum(axis=2)
+                level['slice_count'] = matrix.shape[1]
+                level['slices'][thread] = {name: sparse_runs(matrix[row]) for name, row in rows.items()
+                                           if name != 'total'}
+            pyramid.append(level)
+        return pyramid
 
     def ProcessTimelineEvent(self, timeline_event, parent):
-        start = timeline_event['s'] - self.start_time
-        end = timeline_event['e'] - self.start_time
+        # Account for a single event, returns its name if its children should be processed as well
+        start = timeline_event.s - self.start_time
+        end = timeline_event.e - self.start_time
         if end > start:
-            elapsed = end - start
-            thread = timeline_event['t']
-            name = self.event_name_lookup[timeline_event['n']]
-            if 'js' in timeline_event:
-                script = timeline_event['js']
+            thread = timeline_event.t
+            name = self.event_name_lookup[timeline_event.n]
+            if timeline_event.js is not None:
+                script = timeline_event.js
                 s = start / 1000.0
                 e = end / 1000.0
                 if self.scripts is None:
@@ -886,58 +1552,130 @@ class Trace():
                     self.scripts[thread][script] = {}
                 if name not in self.scripts[thread][script]:
                     self.scripts[thread][script][name] = []
-                new_duration = True
-                if len(self.scripts[thread][script][name]):
-                    for period in self.scripts[thread][script][name]:
-                        if s >= period[0] and e <= period[1]:
-                            new_duration = False
-                            break
-                if new_duration:
+                    self.script_index[(thread, script, name)] = IntervalIndex()
+                # Only keep periods that aren't nested in one that was already kept
+                index = self.script_index[(thread, script, name)]
+                if not index.contains(s, e):
+                    index.add(s, e)
                     self.scripts[thread][script][name].append([s, e])
 
             slice_usecs = self.cpu['slice_usecs']
             first_slice = int(float(start) / float(slice_usecs))
-            last_slice = int(float(end) / float(slice_usecs))
+            # An event ending right on the end of the trace would reach one past the last slice
+            last_slice = min(int(float(end) / float(slice_usecs)), self.slice_matrix[thread].shape[1] - 1)
+            if first_slice <= last_slice:
+                self.AdjustTimelineSlices(thread, first_slice, last_slice, name, parent, start, end)
+            return name
+        return None
+
+    def AddScriptSelfTime(self, timeline_event, script_parent):
+        # A script event's time counts for its script, less the part spent in the script events nested in it
+        self_time = self.script_self_time.setdefault(timeline_event.t, {})
+        self_time[timeline_event.js] = self_time.get(timeline_event.js, 0.0) + \
+                                       (timeline_event.e - timeline_event.s) / 1000.0
+        if script_parent is not None:
+            overlap = min(timeline_event.e, script_parent.e) - max(timeline_event.s, script_parent.s)
+            if overlap > 0:
+                self_time[script_parent.js] -= overlap / 1000.0
+
+    def AddSelfSegments(self, timeline_event, name):
+        # The parts of a main thread event its children don't cover, with the CPU category of the event
+        category = CPU_CATEGORY_OF.get(name, len(CPU_CATEGORIES) - 1)
+        cursor = timeline_event.s
+        if timeline_event.c is not None:
+            for child in sorted(timeline_event.c, key=lambda child: child.s):
+                if child.s > cursor:
+                    self.main_thread_segments.append((cursor, min(child.s, timeline_event.e), category))
+                cursor = max(cursor, child.e)
+                if cursor >= timeline_event.e:
+                    break
+        if timeline_event.e > cursor:
+            self.main_thread_segments.append((cursor, timeline_event.e, category))
+
+    def ProcessScriptExecution(self):
+        # Merge the periods of each script into the disjoint intervals it was executing in (ms)
+        if self.scripts is None:
+            return
+        for thread, scripts in self.scripts.items():
+            if thread == 'main_thread':
+                continue
+            self.script_execution[thread] = {}
+            for script, names in scripts.items():
+                merged = merge_intervals(sorted(period for periods in names.values() for period in periods))
+                total = sum(end - start for start, end in merged)
+                # Events that overlap without nesting are counted twice in the self time, never let it pass the total
+                self.script_execution[thread][script] = {
+                    'intervals': merged, 'total': total,
+                    'self': min(total, max(0.0, self.script_self_time.get(thread, {}).get(script, 0.0)))}
+
+    # Add the time to the given slices and subtract the time from a parent event. Each slice is updated exactly as if
+    # it was done on its own, the slices of one event just don't depend on each other.
+    def AdjustTimelineSlices(self, thread, first_slice, last_slice, name, parent, start, end):
+        # Don't bother adjusting if both the current event and parent are the same category
+        # since they would just cancel each other out.
+        if name == parent:
+            return
+        slice_usecs = self.cpu['slice_usecs']
+        rows = self.slice_rows[thread]
+        matrix = self.slice_matrix[thread]
+        # Most events fall in one or two slices, where the array operations cost more than they save
+        if last_slice - first_slice < 2:
             for slice_number in range(first_slice, last_slice + 1):
                 slice_start = slice_number * slice_usecs
-                slice_end = slice_start + slice_usecs
-                used_start = max(slice_start, start)
-                used_end = min(slice_end, end)
-                slice_elapsed = used_end - used_start
-                self.AdjustTimelineSlice(thread, slice_number, name, parent, slice_elapsed)
-
-            # Recursively process any child events
-            if 'c' in timeline_event:
-                for child in timeline_event['c']:
-                    self.ProcessTimelineEvent(child, name)
-
-    # Add the time to the given slice and subtract the time from a parent event
-    def AdjustTimelineSlice(self, thread, slice_number, name, parent, elapsed):
-        try:
-            # Don't bother adjusting if both the current event and parent are the same category
-            # since they would just cancel each other out.
-            if name != parent:
-                fraction = min(1.0, float(elapsed) / float(self.cpu['slice_usecs']))
-                self.cpu['slices'][thread][name][slice_number] += fraction
-                self.cpu['slices'][thread]['total'][slice_number] += fraction
-                if parent is not None and self.cpu['slices'][thread][parent][slice_number] >= fraction:
-                    self.cpu['slices'][thread][parent][slice_number] -= fraction
-                    self.cpu['slices'][thread]['total'][slice_number] -= fraction
-                # Make sure we didn't exceed 100% in this slice
-                self.cpu['slices'][thread][name][slice_number] = min(1.0,
-                                                                     self.cpu['slices'][thread][name][slice_number])
-
-                # make sure we don't exceed 100% for any slot
-                if self.cpu['slices'][thread]['total'][slice_number] > 1.0:
-                    available = max(0.0, 1.0 - fraction)
-                    for slice_name in self.cpu['slices'][thread].keys():
-                        if slice_name != name:
-                            self.cpu['slices'][thread][slice_name][slice_number] = \
-                                min(self.cpu['slices'][thread][slice_name][slice_number], available)
-                            available = max(0.0, available - self.cpu['slices'][thread][slice_name][slice_number])
-                    self.cpu['slices'][thread]['total'][slice_number] = min(1.0, max(0.0, 1.0 - available))
-        except:
-            pass
+                elapsed = min(slice_start + slice_usecs, end) - max(slice_start, start)
+                self.AdjustTimelineSlice(matrix, rows, slice_number, name, parent,
+                                         min(1.0, elapsed / float(slice_usecs)))
+            return
+        columns = slice(first_slice, last_slice + 1)
+        slice_start = np.arange(first_slice, last_slice + 1) * slice_usecs
+        elapsed = np.minimum(slice_start + slice_usecs, end) - np.maximum(slice_start, start)
+        fraction = np.minimum(1.0, elapsed / float(slice_usecs))
+        used = matrix[rows[name], columns]
+        total = matrix[0, columns]
+        used += fraction
+        total += fraction
+        if parent is not None:
+            parent_used = matrix[rows[parent], columns]
+            taken = np.where(parent_used >= fraction, fraction, 0.0)
+            parent_used -= taken
+            total -= taken
+        # Make sure we didn't exceed 100% in this slice
+        np.minimum(used, 1.0, out=used)
+
+        # make sure we don't exceed 100% for any slot
+        overflow = np.flatnonzero(total > 1.0)
+        if len(overflow):
+            available = np.maximum(0.0, 1.0 - fraction[overflow])
+            overflow += first_slice
+            for row in range(len(rows)):
+                if row != rows[name]:
+                    clamped = np.minimum(matrix[row, overflow], available)
+                    matrix[row, overflow] = clamped
+                    available = np.maximum(0.0, available - clamped)
+            matrix[0, overflow] = np.minimum(1.0, np.maximum(0.0, 1.0 - available))
+
+    def AdjustTimelineSlice(self, matrix, rows, slice_number, name, parent, fraction):
+        # The same update for a single slice, on plain floats
+        row = rows[name]
+        matrix[row, slice_number] = min(1.0, matrix.item(row, slice_number) + fraction)
+        total = matrix.item(0, slice_number) + fraction
+        if parent is not None:
+            parent_row = rows[parent]
+            parent_used = matrix.item(parent_row, slice_number)
+            if parent_used >= fraction:
+                matrix[parent_row, slice_number] = parent_used - fraction
+                total -= fraction
+        matrix[0, slice_number] = total
+
+        # make sure we don't exceed 100% for any slot
+        if total > 1.0:
+            available = max(0.0, 1.0 - fraction)
+            for other in range(len(rows)):
+                if other != row:
+                    clamped = min(matrix.item(other, slice_number), available)
+                    matrix[other, slice_number] = clamped
+                    available = max(0.0, available - clamped)
+            matrix[0, slice_number] = min(1.0, max(0.0, 1.0 - available))
 
             ########################################################################################################################
             # Dependency processing:
@@ -1044,6 +1782,10 @@ class Trace():
                 temp_net_list[1]['transferSize'] = self.networks_list[i][1]['transferSize']
             temp_net_list[1]['responseReceivedTime'] = self.networks_list[i][1]['responseReceivedTime']
             temp_net_list[1]['statusCode'] = self.networks_list[i][1]['statusCode']
+            if 'redirect' in self.networks_list[i][1]:
+                temp_net_list[1]['redirect'] = True
+            if 'redirectedFrom' in self.networks_list[i][1]:
+                temp_net_list[1]['redirectedFrom'] = self.networks_list[i][1]['redirectedFrom']
             self.networks_list[i] = temp_net_list
             unfragmented_url = urldefrag(self.networks_list[i][1]['url'])[0]
             if "localhost.localdomain" in unfragmented_url:
@@ -1054,6 +1796,11 @@ class Trace():
                 self.networks_lookup_url[unfragmented_url].append(self.networks_list[i][0])
             self.networks_lookup_id['Networking_' + str(i)] = temp_net_list[1]
             temp_net_list = []
+        # Point redirect hops at the previous hop's activity
+        _request_activities = dict((net_obj[1]['id'], net_obj[0]) for net_obj in self.networks_list)
+        for net_obj in self.networks_list:
+            if 'redirectedFrom' in net_obj[1]:
+                net_obj[1]['redirectedFrom'] = _request_activities.get(net_obj[1]['redirectedFrom'])
         self.loading_list = [[_id, load_dict] for _id, load_dict in self.loading.items()
                              if ('startTime' in load_dict and load_dict['startTime'] >= 0) and
                              ('endTime' in load_dict and load_dict['endTime'] >= 0)]
@@ -1132,6 +1879,288 @@ class Trace():
         # print(_tmp_merged)
         # print('Last activity: ' + str(self.last_activity[0]))
 
+    def ProcessMainThreadActivity(self):
+        # One sorted sweep over the main thread's top level timeline events: merge them into busy blocks, report the
+        # tasks over LONG_TASK_MS with the Scripting/Loading activities they overlap, and the idle time the main
+        # thread spent waiting on the network. All times are in ms like the activities.
+        main_thread = self.cpu['main_thread']
+        if main_thread is None or 'total_usecs' not in self.cpu:
+            return
+        total = self.cpu['total_usecs'] / 1000.0
+        # Each top level event is a task of its own, even when the next one starts the moment it ends; only
+        # overlapping ones are taken together
+        tasks = merge_intervals(sorted([(event.s - self.start_time) / 1000.0, (event.e - self.start_time) / 1000.0]
+                                       for event in self.timeline_events
+                                       if event.t == main_thread and event.e > event.s), touching=False)
+        busy = merge_intervals(tasks)
+        busy_time = sum(end - start for start, end in busy)
+
+        # Activities sorted by start go into a heap keyed on their end as the long tasks (sorted and disjoint) pass
+        # them, the ones still in the heap after dropping those that ended before a task starts overlap it
+        long_tasks = [{'startTime': start, 'endTime': end, 'duration': end - start, 'activities': []}
+                      for start, end in tasks if end - start > LONG_TASK_MS]
+        activities = sorted(self.scripts_list + self.loading_list, key=lambda tup: tup[1]['startTime'])
+        active = []
+        i = 0
+        for task in long_tasks:
+            while i < len(activities) and activities[i][1]['startTime'] < task['endTime']:
+                heapq.heappush(active, (activities[i][1]['endTime'], i))
+                i += 1
+            while len(active) and active[0][0] <= task['startTime']:
+                heapq.heappop(active)
+            task['activities'] = [activities[j][0] for j in sorted(j for end, j in active)]
+
+        # Idle gaps between the busy blocks, cut down to the parts where a request was in flight
+        gaps = []
+        previous_end = 0.0
+        for start, end in busy + [[total, total]]:
+            if start > previous_end:
+                gaps.append([previous_end, start])
+            previous_end = max(previous_end, end)
+        network = merge_intervals(sorted([net[1]['startTime'], net[1]['endTime']] for net in self.networks_list))
+        waiting = []
+        j = 0
+        for start, end in gaps:
+            while j < len(network) and network[j][1] <= start:
+                j += 1
+            k = j
+            while k < len(network) and network[k][0] < end:
+                waiting.append({'startTime': max(start, network[k][0]), 'endTime': min(end, network[k][1])})
+                k += 1
+
+        self.main_thread_activity = {
+            'longTasks': long_tasks, 'idleGaps': waiting, 'busyTime': busy_time,
+            'idleTime': sum(end - start for start, end in gaps),
+            'networkWaitTime': sum(gap['endTime'] - gap['startTime'] for gap in waiting),
+            'busyRatio': busy_time / total if total > 0 else 0.0}
+
+    def ProcessActivityCPU(self):
+        # Join the main thread's self time segments to the window of every computation activity. The segments are
+        # made disjoint and sorted, so the ones overlapping a window are a contiguous range found by binary search,
+        # and per category prefix sums give the time inside it without walking the range.
+        if not len(self.main_thread_segments):
+            return
+        starts = []
+        ends = []
+        categories = []
+        cursor = None
+        for start, end, category in sorted(self.main_thread_segments):
+            # Only events that weren't properly nested can overlap, the earlier one keeps the time
+            if cursor is not None and start < cursor:
+                start = cursor
+            if end <= start:
+                continue
+            starts.append((start - self.start_time) / 1000.0)
+            ends.append((end - self.start_time) / 1000.0)
+            categories.append(category)
+            cursor = end
+        starts = np.array(starts)
+        ends = np.array(ends)
+        categories = np.array(categories, dtype=np.int64)
+        prefix = np.zeros((len(CPU_CATEGORIES), len(starts) + 1))
+        prefix[categories, np.arange(1, len(starts) + 1)] = ends - starts
+        prefix = np.cumsum(prefix, axis=1)
+        self.main_thread_cpu = (starts, ends, categories, prefix)
+
+        activities = [obj for obj in self.all if not obj[0].startswith('Network')]
+        if not len(activities):
+            return
+        used = self.MainThreadCPU([obj[1]['startTime'] for obj in activities],
+                                  [obj[1]['endTime'] for obj in activities])
+        for i, obj in enumerate(activities):
+            self.activity_cpu[obj[0]] = {category: round(float(used[c, i]), 3) for c, category in
+                                         enumerate(CPU_CATEGORIES)}
+
+    def MainThreadCPU(self, window_starts, window_ends):
+        # Main thread time per CPU category (rows) inside each window (columns), in ms
+        starts, ends, categories, prefix = self.main_thread_cpu
+        window_starts = np.array(window_starts, dtype=np.float64)
+        window_ends = np.array(window_ends, dtype=np.float64)
+        first = np.searchsorted(ends, window_starts, 'right')
+        last = np.searchsorted(starts, window_ends, 'left') - 1
+        used = prefix[:, last + 1] - prefix[:, first]
+        # Take off the parts of the first and last segments that stick out of the window
+        overlapping = np.flatnonzero(first <= last)
+        head = overlapping[starts[first[overlapping]] < window_starts[overlapping]]
+        np.subtract.at(used, (categories[first[head]], head), window_starts[head] - starts[first[head]])
+        tail = overlapping[ends[last[overlapping]] > window_ends[overlapping]]
+        np.subtract.at(used, (categories[last[tail]], tail), ends[last[tail]] - window_ends[tail])
+        used[:, first > last] = 0.0
+        return used
+
+    def ProcessProfileEvents(self, profile_trace_events):
+        # Rebuild the V8 sampling profiles from their Profile/ProfileChunk events and sum the samples into self and
+        # total time per function and per script url. The node tables and sample streams are turned into arrays and
+        # counted with bincount; total time only counts a node when its function (or url) isn't already on the stack
+        # above it, so recursion isn't counted twice. Main thread samples are matched to the Scripting activity
+        # running at that time to list its hot functions. All times are in ms.
+        profiles = collections.OrderedDict()
+        for trace_event in sorted(profile_trace_events, key=lambda e: e['ts']):
+            if 'id' not in trace_event or 'args' not in trace_event or 'data' not in trace_event['args']:
+                continue
+            data = trace_event['args']['data']
+            profile = profiles.setdefault((trace_event['pid'], trace_event['id']),
+                                          {'thread': None, 'startTime': None, 'nodes': [], 'samples': [], 'deltas': []})
+            if trace_event['name'] == 'Profile':
+                profile['thread'] = '{0}:{1}'.format(trace_event['pid'], trace_event['tid'])
+                profile['startTime'] = data.get('startTime', trace_event['ts'])
+                continue
+            if profile['thread'] is None:
+                profile['thread'] = '{0}:{1}'.format(trace_event['pid'], trace_event['tid'])
+            cpu_profile = data.get('cpuProfile', {})
+            profile['nodes'].extend(cpu_profile.get('nodes', []))
+            samples = cpu_profile.get('samples', [])
+            deltas = data.get('timeDeltas', cpu_profile.get('timeDeltas', []))
+            count = min(len(samples), len(deltas))
+            profile['samples'].extend(samples[:count])
+            profile['deltas'].extend(deltas[:count])
+        if not len(profiles):
+            return
+
+        functions = {}
+        function_keys = []
+        function_self = []
+        function_total = []
+        urls = {}
+        url_keys = []
+        url_self = []
+        url_total = []
+        hot = []
+        sample_count = 0
+        sampled_time = 0.0
+        window_starts = np.array([obj[1]['startTime'] for obj in self.scripts_list], dtype=np.float64)
+        window_ends = np.array([obj[1]['endTime'] for obj in self.scripts_list], dtype=np.float64)
+        for profile in profiles.values():
+            if not len(profile['nodes']) or not len(profile['samples']) or profile['startTime'] is None:
+                continue
+            index = {}
+            for node in profile['nodes']:
+                index.setdefault(node['id'], len(index))
+            node_count = len(index)
+            parent = np.full(node_count, -1, dtype=np.int64)
+            node_function = np.zeros(node_count, dtype=np.int64)
+            node_url = np.full(node_count, -1, dtype=np.int64)
+            for node in profile['nodes']:
+                i = index[node['id']]
+                if node.get('parent') in index:
+                    parent[i] = index[node['parent']]
+                for child in node.get('children', []):
+                    if child in index:
+                        parent[index[child]] = i
+                frame = node.get('callFrame', {})
+                key = (frame.get('functionName') or '(anonymous)', frame.get('url', ''), frame.get('lineNumber', -1),
+                       frame.get('columnNumber', -1))
+                if key not in functions:
+                    functions[key] = len(function_keys)
+                    function_keys.append(key)
+                node_function[i] = functions[key]
+                if key[1]:
+                    if key[1] not in urls:
+                        urls[key[1]] = len(url_keys)
+                        url_keys.append(key[1])
+                    node_url[i] = urls[key[1]]
+
+            # Samples weigh the time until the next one, in the order they were taken
+            known = [j for j, sample in enumerate(profile['samples']) if sample in index]
+            times = profile['startTime'] + np.cumsum(np.array(profile['deltas'], dtype=np.float64))[known]
+            sample_nodes = np.array([index[profile['samples'][j]] for j in known], dtype=np.int64)
+            order = np.argsort(times, kind='mergesort')
+            times = times[order]
+            sample_nodes = sample_nodes[order]
+            weights = np.diff(times, append=times[-1:]) / 1000.0
+            node_self = np.bincount(sample_nodes, weights, minlength=node_count)
+            sample_count += len(sample_nodes)
+            sampled_time += float(weights.sum())
+
+            # Walk the tree in pre-order, keeping how many times each function and url is on the current stack
+            children = [[] for i in range(node_count)]
+            for i in range(node_count):
+                if parent[i] >= 0:
+                    children[parent[i]].append(i)
+            pre_order = []
+            outer_function = np.zeros(node_count, dtype=bool)
+            outer_url = np.zeros(node_count, dtype=bool)
+            on_stack = collections.Counter()
+            stack = [(i, False) for i in reversed(range(node_count)) if parent[i] < 0]
+            while len(stack):
+                i, leaving = stack.pop()
+                if leaving:
+                    on_stack[('f', node_function[i])] -= 1
+                    on_stack[('u', node_url[i])] -= 1
+                    continue
+                pre_order.append(i)
+                outer_function[i] = on_stack[('f', node_function[i])] == 0
+                outer_url[i] = node_url[i] >= 0 and on_stack[('u', node_url[i])] == 0
+                on_stack[('f', node_function[i])] += 1
+                on_stack[('u', node_url[i])] += 1
+                stack.append((i, True))
+                stack.extend((child, False) for child in reversed(children[i]))
+            node_total = node_self.copy()
+            for i in reversed(pre_order):
+                if parent[i] >= 0:
+                    node_total[parent[i]] += node_total[i]
+
+            size = len(function_keys)
+            function_self.append(np.bincount(node_function, node_self, minlength=size))
+            function_total.append(np.bincount(node_function[outer_function], node_total[outer_function],
+                                              minlength=size))
+            size = len(url_keys)
+            has_url = node_url >= 0
+            url_self.append(np.bincount(node_url[has_url], node_self[has_url], minlength=size))
+            url_total.append(np.bincount(node_url[outer_url], node_total[outer_url], minlength=size))
+
+            # The Scripting activity a main thread sample falls in: the last one started before it, if still running
+            if profile['thread'] == self.cpu['main_thread'] and len(self.scripts_list):
+                sample_times = (times - self.start_time) / 1000.0
+                activity = np.searchsorted(window_starts, sample_times, 'right') - 1
+                inside = activity >= 0
+                inside[inside] = sample_times[inside] <= window_ends[activity[inside]]
+                # A sample only counts up to the end of its activity, not for the gap to the next sample after it
+                clipped = np.minimum(weights[inside], window_ends[activity[inside]] - sample_times[inside])
+                hot.append((activity[inside], node_function[sample_nodes[inside]], clipped))
+
+        if not len(function_self):
+            return
+
+        def total_up(columns, size):
+            return np.sum([np.pad(column, (0, size - len(column)), 'constant') for column in columns], axis=0)
+
+        function_self = total_up(function_self, len(function_keys))
+        function_total = total_up(function_total, len(function_keys))
+        url_self = total_up(url_self, len(url_keys))
+        url_total = total_up(url_total, len(url_keys))
+        self.profile = {
+            'samples': sample_count, 'sampledTime': round(sampled_time, 3),
+            'functions': [{'functionName': function_keys[i][0], 'url': function_keys[i][1],
+                           'lineNumber': function_keys[i][2], 'columnNumber': function_keys[i][3],
+                           'selfTime': round(float(function_self[i]), 3),
+                           'totalTime': round(float(function_total[i]), 3)}
+                          for i in np.argsort(-function_self, kind='mergesort')
+                          if function_keys[i][0] not in PROFILE_META_NODES],
+            'urls': [{'url': url_keys[i], 'selfTime': round(float(url_self[i]), 3),
+                      'totalTime': round(float(url_total[i]), 3)}
+                     for i in np.argsort(-url_self, kind='mergesort')]}
+
+        if not len(hot):
+            return
+        activity = np.concatenate([h[0] for h in hot])
+        function = np.concatenate([h[1] for h in hot])
+        weights = np.concatenate([h[2] for h in hot])
+        meta = np.array([key[0] in PROFILE_META_NODES for key in function_keys], dtype=bool)
+        real = ~meta[function]
+        activity = activity[real]
+        function = function[real]
+        weights = weights[real]
+        pairs, inverse = np.unique(activity * len(function_keys) + function, return_inverse=True)
+        pair_time = np.bincount(inverse, weights)
+        for j in np.lexsort((-pair_time, pairs // len(function_keys))):
+            _nodeId = self.scripts_list[pairs[j] // len(function_keys)][0]
+            hot_functions = self.activity_hot_functions.setdefault(_nodeId, [])
+            if len(hot_functions) < PROFILE_HOT_FUNCTIONS:
+                key = function_keys[pairs[j] % len(function_keys)]
+                hot_functions.append({'functionName': key[0], 'url': key[1], 'lineNumber': key[2],
+                                      'selfTime': round(float(pair_time[j]), 3)})
+
     def order_layout(self):
         i = 0
         for net_obj in self.networks_list:
@@ -1315,6 +2344,9 @@ class Trace():
         i = cr_len - 1
         _networkingTime = 0
         _computationTime = 0
+        # The part of each Scripting and Networking activity that is on the critical path, to split into phases below
+        _scripting = []
+        _networking = []
         while i >= 1:
             _nodeId = self.critical_path[i]
             _prev = self.critical_path[i - 1]
@@ -1332,13 +2364,35 @@ class Trace():
                 _networkingTime += duration
             else:
                 _computationTime += duration
+            if _nodeId.startswith('Scripting'):
+                _scripting.append((self.G.node[_nodeId]['startTime'], self.G.node[_nodeId]['startTime'] + duration))
+            elif _nodeId.startswith('Networking'):
+                _networking.append((_nodeId, self.G.node[_nodeId]['startTime'] + duration))
         duration = _endTime - self.G.node[_prev]['startTime']
         if _nodeId.startswith('Networking'):
             _networkingTime += duration
         else:
             _computationTime += duration
+        if _prev.startswith('Scripting'):
+            _scripting.append((self.G.node[_prev]['startTime'], _endTime))
+        elif _prev.startswith('Networking'):
+            _networking.append((_prev, _endTime))
         self.networkingTime = round(_networkingTime, 2)
         self.computationTime = round(_computationTime, 2)
+        if self.main_thread_cpu is not None:
+            used = self.MainThreadCPU([start for start, end in _scripting], [end for start, end in _scripting])
+            self.critical_path_scripting = {phase: round(float(used[CPU_CATEGORIES.index(category)].sum()), 2)
+                                            for phase, category in SCRIPT_PHASES}
+        # Phases of a request past the time the next activity on the path was triggered don't count
+        _phases = dict((phase, 0) for phase in NETWORK_PHASES)
+        for _nodeId, _end in _networking:
+            for phase, (start, end) in self.network_phase_spans.get(_nodeId, {}).items():
+                _phases[phase] += max(0, min(end, _end) - start)
+        self.critical_path_networking = {phase: round(duration, 2) for phase, duration in _phases.items()}
+        self.critical_path_redirect_time = round(sum(max(0, min(self.networks_lookup_id[_nodeId]['endTime'], _end) -
+                                                          self.networks_lookup_id[_nodeId]['startTime'])
+                                                      for _nodeId, _end in _networking
+                                                      if self.networks_lookup_id[_nodeId].get('redirect')), 2)
 
         #calculate compute and network on crp
         #calcualte CRP bytes (match with RTT)
@@ -1369,7 +2423,19 @@ class Trace():
             ###
             if _nodeId.startswith('Networking') or _nodeId.startswith('Loading') or _nodeId.startswith('Scripting'):
                 if _nodeId.startswith('Networking'):
-                    if _nodeData['fromScript'] in ['Null', None, ''] and _nodeData['startTime'] > \
+                    # A redirect hop waits on the previous hop of its chain, whatever started the chain
+                    if _nodeData.get('redirectedFrom') is not None:
+                        _hopId = _nodeData['redirectedFrom']
+                        a2_startTime, a1_triggered = self.edge_start(self.G.node[_hopId]['endTime'],
+                                                                     self.G.node[_nodeId]['startTime'])
+                        self.G.add_edge(_hopId, _nodeId,
+                                        startTime=a2_startTime,
+                                        endTime=self.G.node[_nodeId]['startTime'])
+                        self.deps.append({'time': a1_triggered, 'a1': _hopId, 'a2': _nodeId})
+                        if a1_triggered == -1:
+                            a1_triggered = self.G.node[_hopId]['endTime']
+                        self.deps_parent.setdefault(_nodeId, []).append((_hopId, a1_triggered))
+                    elif _nodeData['fromScript'] in ['Null', None, ''] and _nodeData['startTime'] > \
                             self.G.node[_parse0Id][
                                 'startTime']:
                         _parseID = self.find_parse_id(_nodeData)
@@ -1846,11 +2912,24 @@ class Trace():
         logging.info('start_ts: ' + str(self.start_time))
         self.Process_Loading_Render_Painting_Network()
         self.ProcessNetworkEvents(self.network_trace_events)
+        if self.partial:
+            self.DropIncompleteRequests()
         self.ProcessLoadingEvents(self.loading_trace_events)
         self.ProcessRenderingEvents(self.rendering_trace_events)
         self.ProcessPaintingEvents(self.painting_trace_events)
         self.ProcessNetlogEvent(self.netlog_trace_events)
+        if self.scripts is None or str(self.scripts['main_thread']) not in self.scripts:
+            # E.g. a salvaged trace cut off before the first script ran
+            logging.warning('No script executed on the main thread: ' + str(self.trace))
+            return False, False, False
         self.sort_by_startTime()
+        self.JoinHTTP2Streams()
+        self.ProcessConnections()
+        self.ProcessNetworkPhases()
+        self.ProcessBandwidth()
+        self.ProcessMainThreadActivity()
+        self.ProcessActivityCPU()
+        self.ProcessProfileEvents(self.profile_trace_events)
         if not self.dependency():
             return False, False, False
         self.order_layout()
@@ -1873,9 +2952,22 @@ class Trace():
         self.critical_path.reverse()
         print('Critical Path: ' + str(self.critical_path))
         self.crp_analysis()
+        self.FlagCriticalConnections()
         return self.WriteOutputlog_new(mode='lib'), self.start_time, self.cpu
 
 
+def parse_trace_chunk(job):
+    # Worker side of Trace.ReadTraceEventsParallel(): decode one byte range and keep the events any stage routes
+    trace_file, start, end, layout, prune = job
+    trace = Trace(trace_file, cache=False)
+    keep_item = trace.KeepTraceItem if prune else None
+    kept_events = []
+    for trace_event in trace_reader.iter_chunk_events(trace_file, start, end, layout, keep_item):
+        if trace.RouteTraceEvent(trace_event):
+            kept_events.append(trace_event)
+    return kept_events
+
+
 ########################################################################################################################
 #   Main Entry Point
 ########################################################################################################################
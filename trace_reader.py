@@ -0,0 +1,580 @@
+"""
+Incremental readers for Chrome trace files.
+
+Trace files come in a few layouts:
+  - a JSON array of events, either as objects or as JSON encoded strings (what chrome_launcher.js writes)
+  - a JSON object with the events in its 'traceEvents' array
+  - one event per line, with or without the enclosing array
+
+The readers below pull the file in fixed size blocks and decode one element at a time, so memory use is bounded
+by the largest single event rather than by the size of the file. Gzip and zstd compressed traces are recognized by
+their magic bytes and decompressed on the fly. A file that was cut off raises TruncatedTrace, or can be salvaged up to
+the last complete event; an element that isn't valid JSON raises MalformedTrace with its byte offset.
+"""
+import gzip
+import io
+import json as _json
+import os
+import re
+import struct
+
+try:
+    import ujson as json
+except:
+    import json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+READ_SIZE = 1 << 20
+# Largest single element read ahead for before one that doesn't decode is given up on as malformed
+MAX_ITEM_SIZE = 64 << 20
+# How close to the end of the data a decode error has to be for the element to be merely incomplete (the longest
+# partial token is an escaped surrogate pair, '\ud83d\ude00')
+_CUT_OFF_SLACK = 12
+
+_decoder = _json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+_separators = re.compile(r'[ \t\n\r,]*')
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# What reading a cut off file raises: gzip and zstd streams that end early
+_read_errors = (EOFError,) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+class TruncatedTrace(ValueError):
+    """
+    The trace ends in the middle of an element, e.g. because the browser was killed while the trace was written.
+    """
+
+
+class MalformedTrace(ValueError):
+    """
+    The trace holds an element that is not valid JSON, anywhere but at a cut off end of the file.
+    """
+
+
+def open_trace(path):
+    """
+    Open a trace file for reading as text, decompressing gzip and zstd files while they are read.
+    """
+    reader = open_decompressed(path)
+    if reader is None:
+        return open(path, 'r', encoding='utf-8')
+    return io.TextIOWrapper(io.BufferedReader(CompressedStream(reader)), encoding='utf-8')
+
+
+def open_decompressed(path):
+    """
+    Open a gzip or zstd compressed trace as a binary stream of the decompressed data, None if it isn't compressed.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(path, 'rb')
+    if magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise ImportError('The zstandard module is needed to read ' + path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_across_frames=True, closefd=True)
+    return None
+
+
+class CompressedStream(io.RawIOBase):
+    """
+    Ends the decompressed data where a cut off gzip or zstd file ends instead of raising. The error would otherwise
+    discard whatever the buffered layers above had already decompressed; the trace reader sees an unterminated element
+    instead and raises TruncatedTrace. read1() decompresses one block at a time, so nothing is lost below either.
+    """
+    def __init__(self, f):
+        self.f = f
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        try:
+            data = self.f.read1(len(b))
+        except _read_errors:
+            return 0
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.f.close()
+        io.RawIOBase.close(self)
+
+
+def ends_complete(path, tail_size=4096):
+    """
+    Check, without decompressing anything, that a trace ends the way a finished one does: True if it ends with the ']'
+    or '}' written when tracing finished, False if it was cut off, None if that can't be told.
+    The JSON inside a compressed trace isn't read, so those are False when the compressed stream is cut off and None
+    otherwise.
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if magic.startswith(GZIP_MAGIC):
+            return _gzip_complete(f, size)
+        if magic.startswith(ZSTD_MAGIC):
+            return _zstd_complete(f, size)
+        f.seek(max(0, size - tail_size))
+        tail = f.read()
+    return tail.rstrip()[-1:] in (b']', b'}')
+
+
+def _gzip_complete(f, size):
+    # The 8 byte trailer ends with the decompressed size mod 2**32 (ISIZE). Deflate can neither shrink data by more
+    # than ~1032:1 nor grow it by more than 5 bytes per 64 KB stored block, so the bytes where a cut off file's trailer
+    # would be usually give a size no decompressed length in that range matches. Past 4 MB compressed every ISIZE fits.
+    f.seek(0)
+    header = f.read(64 << 10)
+    if len(header) < 10:
+        return False
+    flags = header[3]
+    start = 10
+    if flags & 4:
+        if len(header) < start + 2:
+            return False
+        start += 2 + struct.unpack('<H', header[start:start + 2])[0]
+    for flag in (8, 16):
+        if flags & flag:
+            end = header.find(b'\0', start)
+            if end < 0:
+                return None
+            start = end + 1
+    if flags & 2:
+        start += 2
+    compressed = size - start - 8
+    if compressed < 2:
+        return False
+    f.seek(size - 4)
+    isize = struct.unpack('<I', f.read(4))[0]
+    lowest = compressed - 5 * (compressed // 65535 + 1)
+    highest = compressed * 1032
+    # The smallest length >= lowest with this ISIZE
+    length = isize + max(0, -(-(lowest - isize) // (1 << 32))) * (1 << 32)
+    if length > highest:
+        return False
+    return None
+
+
+def _zstd_complete(f, size):
+    # Walk the frames and block headers, seeking over the block contents, and check the last frame ends with the file
+    offset = 0
+    while offset < size:
+        f.seek(offset)
+        header = f.read(14)
+        if len(header) < 8:
+            return False
+        magic = struct.unpack('<I', header[:4])[0]
+        if magic & 0xFFFFFFF0 == 0x184D2A50:
+            # Skippable frame
+            offset += 8 + struct.unpack('<I', header[4:8])[0]
+            continue
+        if header[:4] != ZSTD_MAGIC:
+            return None
+        descriptor = header[4]
+        single_segment = descriptor & 0x20
+        offset += 5 + (0 if single_segment else 1) + [0, 1, 2, 4][descriptor & 3] + \
+                  [1 if single_segment else 0, 2, 4, 8][descriptor >> 6]
+        while True:
+            f.seek(offset)
+            block = f.read(3)
+            if len(block) < 3:
+                return False
+            block = block[0] | block[1] << 8 | block[2] << 16
+            block_type = (block >> 1) & 3
+            offset += 3 + (1 if block_type == 1 else block >> 3)
+            if block & 1:
+                break
+        if descriptor & 4:
+            offset += 4
+    if offset > size:
+        return False
+    return None
+
+
+class LazyTraceEvent(dict):
+    """
+    A trace event whose args are held as raw JSON and only decoded the first time a handler reads them.
+    Everything that walks or compares the whole event (iteration, keys(), items(), ==, copy(), json.dumps) decodes
+    them first, so it behaves like the plain dict it stands for.
+    Only events loaded from the trace cache are lazy: the JSON reader decodes an element with its args in one go.
+    """
+    __slots__ = ('raw_args',)
+
+    def __init__(self, fields, raw_args):
+        dict.__init__(self, fields)
+        self.raw_args = raw_args
+
+    def decode_args(self):
+        if self.raw_args is not None:
+            dict.__setitem__(self, 'args', json.loads(self.raw_args))
+            self.raw_args = None
+        return self
+
+    def __missing__(self, key):
+        if key == 'args' and self.raw_args is not None:
+            return self.decode_args()['args']
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or (key == 'args' and self.raw_args is not None)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        if key == 'args':
+            self.raw_args = None
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key == 'args':
+            self.decode_args()
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key == 'args':
+            self.decode_args()
+        return dict.pop(self, key, *default)
+
+    def __len__(self):
+        return dict.__len__(self) + (1 if self.raw_args is not None else 0)
+
+    def __iter__(self):
+        return dict.__iter__(self.decode_args())
+
+    def keys(self):
+        return dict.keys(self.decode_args())
+
+    def values(self):
+        return dict.values(self.decode_args())
+
+    def items(self):
+        return dict.items(self.decode_args())
+
+    def copy(self):
+        return dict.copy(self.decode_args())
+
+    def __eq__(self, other):
+        if isinstance(other, LazyTraceEvent):
+            other.decode_args()
+        return dict.__eq__(self.decode_args(), other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return dict.__repr__(self.decode_args())
+
+
+def decoded(trace_event):
+    # Make sure a trace event is a plain dict with its args decoded, e.g. before writing it out
+    if isinstance(trace_event, LazyTraceEvent):
+        return dict(trace_event.decode_args())
+    return trace_event
+
+
+def cut_off(error, text):
+    # Whether a decode error is only due to the element running to the end of the text
+    if not isinstance(error, _json.JSONDecodeError):
+        return False
+    return error.msg.startswith('Unterminated string') or error.pos >= len(text.rstrip()) - _CUT_OFF_SLACK
+
+
+class TraceStream():
+    def __init__(self, f, read_size=READ_SIZE, max_item_size=MAX_ITEM_SIZE):
+        self.f = f
+        self.read_size = read_size
+        self.max_item_size = max_item_size
+        self.buf = ''
+        self.pos = 0
+        self.offset = 0
+        self.eof = False
+
+    def byte_offset(self, pos=None):
+        # Offset in the (decompressed) file of a position in the buffer
+        return self.offset + len(self.buf[:self.pos if pos is None else pos].encode('utf-8'))
+
+    def fill(self, size=None):
+        # Drop the consumed part of the buffer and append the next block
+        if self.eof:
+            return False
+        try:
+            chunk = self.f.read(size or self.read_size)
+        except _read_errors as e:
+            self.eof = True
+            raise TruncatedTrace('Truncated trace: ' + str(e))
+        except UnicodeDecodeError as e:
+            self.eof = True
+            # Only a multi-byte character split by the end of the file is a cut off, other bad bytes are malformed
+            if e.reason == 'unexpected end of data':
+                raise TruncatedTrace('Truncated trace: ' + str(e))
+            raise MalformedTrace('Malformed trace: invalid UTF-8 after byte offset {0:d}: {1}'.format(
+                self.byte_offset(len(self.buf)), e.reason))
+        if not chunk:
+            self.eof = True
+            return False
+        self.offset = self.byte_offset()
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def skip(self, pattern=_whitespace):
+        # Skip over the separators and return the next significant character ('' at the end of the file)
+        while True:
+            self.pos = pattern.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        found = self.skip()
+        if found == '':
+            raise TruncatedTrace('Truncated trace: expected {0!r} at the end of the file'.format(char))
+        if found != char:
+            raise MalformedTrace('Malformed trace: expected {0!r} at byte offset {1:d}'.format(char,
+                                                                                              self.byte_offset()))
+        self.pos += 1
+
+    def decode(self):
+        # Decode the JSON value at the current position, reading more of the file if it is incomplete.
+        # A value that ends exactly at the end of the buffer may be a truncated number so it is retried as well.
+        # Only an element that fails where the data runs out is incomplete, and it is read ahead for at most
+        # max_item_size; anything else is malformed and raised right away instead of pulling in the rest of the file.
+        self.skip()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError as e:
+                if not cut_off(e, self.buf):
+                    raise MalformedTrace('Malformed trace: element at byte offset {0:d}: {1}'.format(
+                        self.byte_offset(), getattr(e, 'msg', e)))
+                if self.eof:
+                    raise TruncatedTrace('Truncated trace: ' + str(e))
+                if len(self.buf) - self.pos >= self.max_item_size:
+                    raise MalformedTrace('Malformed trace: element at byte offset {0:d} is still incomplete after '
+                                         '{1:d} bytes'.format(self.byte_offset(), self.max_item_size))
+            # Grow geometrically so a single huge event is not re-scanned once per block
+            self.fill(max(self.read_size, len(self.buf) - self.pos))
+
+
+def iter_array_items(stream):
+    stream.expect('[')
+    while True:
+        char = stream.skip(_separators)
+        if char == ']':
+            stream.pos += 1
+            return
+        if char == '':
+            raise TruncatedTrace('Truncated trace: unterminated array')
+        yield stream.decode()
+
+
+def iter_trace_items(f, read_size=READ_SIZE):
+    """
+    Yield the raw elements of a trace file: dicts, or JSON encoded strings for the array-of-strings layout.
+    """
+    stream = TraceStream(f, read_size)
+    char = stream.skip()
+    if char == '[':
+        for item in iter_array_items(stream):
+            yield item
+        return
+    if char != '{':
+        if char == '':
+            return
+        raise MalformedTrace('Malformed trace: unexpected {0!r} at the start of the file'.format(char))
+
+    # Walk the first object key by key so a 'traceEvents' array is streamed instead of decoded as a whole
+    stream.pos += 1
+    first = {}
+    while True:
+        char = stream.skip(_separators)
+        if char == '}':
+            stream.pos += 1
+            break
+        key = stream.decode()
+        stream.expect(':')
+        if key == 'traceEvents' and stream.skip() == '[':
+            for item in iter_array_items(stream):
+                yield item
+            first = None
+        else:
+            value = stream.decode()
+            if first is not None:
+                first[key] = value
+    if first is None:
+        return
+
+    # No 'traceEvents': the object was the first of a sequence of events, one per line
+    yield first
+    while stream.skip(_separators):
+        yield stream.decode()
+
+
+def iter_trace_events(f, read_size=READ_SIZE, keep_item=None, on_truncated=None):
+    # keep_item, if given, is called with each raw element and can skip it before it is decoded.
+    # on_truncated, if given, is called with the reason instead of raising TruncatedTrace when the file is cut off;
+    # every complete event before that point has been yielded by then.
+    try:
+        for item in iter_trace_items(f, read_size):
+            if keep_item is not None and not keep_item(item):
+                continue
+            if isinstance(item, str):
+                item = json.loads(item)
+            yield item
+    except TruncatedTrace as e:
+        if on_truncated is None:
+            raise
+        on_truncated(str(e))
+
+
+########################################################################################################################
+#   Chunked reading for parallel parsing
+########################################################################################################################
+# Element boundaries that can be found without parsing from the start of the file:
+#   strings - in the array-of-strings layout every quote inside an element is escaped, so '}","{' only ever
+#             appears between two elements
+#   lines   - one event per line; JSON strings can not hold a raw newline
+_string_boundary = re.compile(rb'\}"[ \t\r\n]*,[ \t\r\n]*"\{')
+_line_boundary = re.compile(rb'\n')
+
+
+def trace_layout(path, sample_size=READ_SIZE):
+    """
+    Return 'strings' or 'lines' if an uncompressed trace can be split at byte offsets, None otherwise.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(sample_size)
+    if head.startswith(GZIP_MAGIC) or head.startswith(ZSTD_MAGIC):
+        return None
+    text = head.lstrip()
+    if text.startswith(b'["{'):
+        return 'strings'
+    # Only call it one event per line if the first complete lines each hold a whole event
+    lines = [line.strip(b'[],\r\n\t ') for line in head.split(b'\n')[:-1]]
+    lines = [line for line in lines if line]
+    if len(lines) < 2:
+        return None
+    for line in lines[:2]:
+        try:
+            event = json.loads(line.decode('utf-8'))
+        except ValueError:
+            return None
+        if not isinstance(event, dict) or 'ph' not in event:
+            return None
+    return 'lines'
+
+
+def split_trace(path, count):
+    """
+    Split a trace into at most count (start, end) byte ranges that begin and end on element boundaries.
+    Returns (layout, ranges), or None if the trace can not be split.
+    """
+    layout = trace_layout(path)
+    if layout is None:
+        return None
+    boundary = _string_boundary if layout == 'strings' else _line_boundary
+    size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as f:
+        for i in range(1, count):
+            position = max(offsets[-1], size * i // count)
+            f.seek(position)
+            while True:
+                block = f.read(READ_SIZE)
+                match = boundary.search(block)
+                if match:
+                    # Cut right after the closing quote (or newline) so the next range starts on a separator
+                    offsets.append(position + match.start() + (2 if layout == 'strings' else 1))
+                    break
+                if len(block) < READ_SIZE:
+                    break
+                # Step back a little so a boundary straddling two blocks is not missed
+                position += len(block) - 8
+                f.seek(position)
+    offsets = sorted(set(offsets))
+    offsets.append(size)
+    return layout, [(offsets[i], offsets[i + 1]) for i in range(len(offsets) - 1) if offsets[i + 1] > offsets[i]]
+
+
+def iter_chunk_events(path, start, end, layout, keep_item=None):
+    # Decode errors are raised as TraceStream raises them: TruncatedTrace if the file ends in the middle of an element
+    # (only the last chunk can), MalformedTrace with the byte offset of the error otherwise
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+        last = not f.read(1)
+    try:
+        text = data.decode('utf-8')
+    except UnicodeDecodeError as e:
+        if last and e.reason == 'unexpected end of data':
+            raise TruncatedTrace('Truncated trace: ' + str(e))
+        raise MalformedTrace('Malformed trace: invalid UTF-8 at byte offset {0:d}: {1}'.format(start + e.start,
+                                                                                             e.reason))
+    if last and text.rstrip()[-1:] not in (['}', ']'] if layout == 'lines' else [']']):
+        raise TruncatedTrace('Truncated trace: unterminated array')
+
+    def byte_offset(pos):
+        return start + len(text[:pos].encode('utf-8'))
+
+    if layout == 'strings':
+        lead = len(text) - len(text.lstrip('[], \t\r\n'))
+        items = text.strip('[], \t\r\n')
+        try:
+            items = json.loads('[' + items + ']') if items else []
+        except ValueError:
+            # The '[' stands in for the character before lead
+            raise decode_error('[' + items + ']', lambda pos: byte_offset(lead - 1 + pos), last)
+        for item in items:
+            if keep_item is None or keep_item(item):
+                try:
+                    yield json.loads(item)
+                except ValueError:
+                    # The element's offset is only known as far as it is written the way Chrome escapes it
+                    item_start = text.find(_json.dumps(item, ensure_ascii=False)[1:-1])
+                    if item_start < 0:
+                        item_start = lead
+                    raise decode_error(item, lambda pos: byte_offset(item_start), False)
+        return
+    position = 0
+    for line in text.split('\n'):
+        item = line.strip('[],\r\n\t ')
+        item_start = position + line.find(item)
+        position += len(line) + 1
+        if item and (keep_item is None or keep_item(item)):
+            try:
+                yield json.loads(item)
+            except ValueError:
+                raise decode_error(item, lambda pos: byte_offset(item_start + pos), last and position > len(text))
+
+
+def decode_error(text, byte_offset, last):
+    # The error to raise for an element that failed to decode; byte_offset maps a position in text to the file.
+    # The standard library decoder is run again for the position of the error.
+    try:
+        _json.loads(text)
+        error = ValueError('undecodable element')
+    except ValueError as e:
+        error = e
+    if last and cut_off(error, text):
+        return TruncatedTrace('Truncated trace: ' + str(error))
+    return MalformedTrace('Malformed trace: error at byte offset {0:d}: {1}'.format(
+        byte_offset(getattr(error, 'pos', 0)), getattr(error, 'msg', error)))